@@ -2,34 +2,44 @@
 # Imports
 #----------------------------------------------------------------------------#
 
+import hmac
+import ipaddress
 import json
-import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, abort, jsonify
+import os
+from flask import Blueprint, Flask, current_app, render_template, stream_template, stream_with_context, request, Response, flash, redirect, url_for, abort, jsonify, g, send_file
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
 import logging
 from logging import Formatter, FileHandler
-from forms import *
-from flask_migrate import Migrate
+from forms import ArtistForm, ShowForm, VenueForm
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import groupby
 import re
-from model import Genre, Venue, Artist, Show
-
-#----------------------------------------------------------------------------#
-# App Config.
-#----------------------------------------------------------------------------#
-
-app = Flask(__name__)
-moment = Moment(app)
-app.config.from_object('config')
-db = SQLAlchemy(app)
-
-# connect to a local postgresql database
-migrate = Migrate(app, db)
-
-
+import uuid
+from model import db, Genre, Venue, Artist, Show, bump_version, sync_genres, update_columns
+from scheduling import ScheduleError, schedule_shows
+from jobs import CATALOG_LISTENERS, make_queue, run_worker
+import geo
+from facets import FACET_ORDER, FacetIndexes
+from autocomplete import Autocomplete
+from ratelimit import Admission, MemoryBucketStore, RateLimiter, TimedQueuePool, pool_wait, retry_after_header
+from profiling import StackSampler
+import slowlog
+import readmodels
+import changefeed
+import softdelete
+import idempotency
+import recommend
+import health
+import images
+from softdelete import soft_delete
+from calendars import FeedCache
+from shards import ShardRouter, UnknownShard, current_shard, fan_out
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm.exc import StaleDataError
 
 #----------------------------------------------------------------------------#
 # Filters.
@@ -37,6 +47,10 @@ migrate = Migrate(app, db)
 
 
 def format_datetime(value, format='medium'):
+    # dateutil and babel are only imported the first time a date is formatted
+    import babel.dates
+    import dateutil.parser
+
     date = dateutil.parser.parse(value)
     if format == 'full':
         format = "EEEE MMMM, d, y 'at' h:mma"
@@ -45,74 +59,333 @@ def format_datetime(value, format='medium'):
     return babel.dates.format_datetime(date, format)
 
 
-app.jinja_env.filters['datetime'] = format_datetime
+def format_phone(value):
+    # phones are stored as digits only
+    if not value:
+        return value
+    return value[:3] + '-' + value[3:6] + '-' + value[6:]
+
+
+def image_url(kind, id, link, size):
+    # the resized copy of an image_link; ?v= changes with the link, so browsers can keep it
+    if not link:
+        return ''
+    return url_for('main.entity_image', kind=kind, id=id, size=size, v=images.link_version(link))
+
+
+#----------------------------------------------------------------------------#
+# App Config.
+#----------------------------------------------------------------------------#
+
+moment = Moment()
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    # config.py holds a default for every setting; config (an object, e.g. the
+    # benchmarks' settings class) and then the Python file FYYUR_SETTINGS
+    # names (benchmarks, staging) override some of them
+    app.config.from_object('config')
+    if config is not None:
+        app.config.from_object(config)
+    app.config.from_envvar('FYYUR_SETTINGS', silent=True)
+    if app.config['PROXY_HOPS']:
+        # request.remote_addr (rate limits), scheme and host (shard routing)
+        # as the trusted proxies saw them
+        hops = app.config['PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    uris = [app.config['SQLALCHEMY_DATABASE_URI'], *app.config.get('SHARDS', {}).values()]
+    if all(uri.startswith('postgresql') for uri in uris):
+        # time connection checkouts so admission control can see pool pressure
+        # a copy: the dict from config.py is shared by every app built
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {},
+                                                       poolclass=TimedQueuePool)
+
+    # connect to a local postgresql database
+    db.init_app(app)
+    moment.init_app(app)
+    # imported here rather than at the top, so only building an app loads
+    # alembic (Flask-Migrate pulls in all of it), not importing this module
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+    app.jinja_env.filters['datetime'] = format_datetime
+    app.jinja_env.filters['phone'] = format_phone
+    app.jinja_env.globals['image_url'] = image_url
+
+    if not app.debug:
+        file_handler = FileHandler('error.log')
+        file_handler.setFormatter(
+            Formatter(
+                '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
+        )
+        app.logger.setLevel(logging.INFO)
+        file_handler.setLevel(logging.INFO)
+        app.logger.addHandler(file_handler)
+        app.logger.info('errors')
+
+    init_services(app)
+    app.register_blueprint(main)
+    return app
+
+
+#----------------------------------------------------------------------------#
+# Services.
+#----------------------------------------------------------------------------#
+
+# Caches, queues and limiters are built by create_app() from the config of
+# the app they serve and kept in app.extensions['fyyur']; the names below
+# stand for the current app's.
+
+def _service(name):
+    return LocalProxy(lambda: current_app.extensions['fyyur'][name])
+
+
+job_queue = _service('job_queue')
+facet_indexes = _service('facet_indexes')
+autocomplete = _service('autocomplete')
+calendar_feeds = _service('calendar_feeds')
+image_proxy = _service('image_proxy')
+shard_router = _service('shard_router')
+rate_limiter = _service('rate_limiter')
+admission = _service('admission')
+profiler = _service('profiler')
+warmup = _service('warmup')
+readiness = _service('readiness')
+
+
+def init_services(app):
+    config = app.config
+    migration_parents = health.revision_parents(os.path.join(app.root_path, 'migrations', 'versions'))
+    min_revision = config['READY_MIN_REVISION'] or health.head(migration_parents)
+    services = {
+        # follow-up work for writes is queued and run by `flask worker`
+        'job_queue': make_queue(config['JOB_QUEUE_BACKEND'], db.session, config['JOB_MAX_ATTEMPTS']),
+        # genre/state/seeking/upcoming bitmaps behind /artists/browse and
+        # /venues/browse, patched after each committed write
+        'facet_indexes': FacetIndexes(config['FACET_MAX_AGE']),
+        # venue/artist/genre name suggestions, kept current by session events
+        'autocomplete': Autocomplete(config['AUTOCOMPLETE_MAX_AGE']),
+        # rendered .ics feeds, dropped when shows, venues or artists change
+        'calendar_feeds': FeedCache(config['CALENDAR_MAX_AGE'], config['CALENDAR_CACHE_SIZE'],
+                                    config['CALENDAR_UID_DOMAIN']),
+        # venue/artist images fetched once, resized and cached on disk, see /images
+        'image_proxy': images.ImageProxy(
+            images.DiskCache(config['IMAGE_CACHE_DIR'], config['IMAGE_CACHE_MAX_BYTES']),
+            config['IMAGE_SIZES'], config['IMAGE_ORIGIN'], config['IMAGE_FETCH_TIMEOUT'],
+            config['IMAGE_MAX_SOURCE_BYTES'], config['IMAGE_QUALITY'], config['IMAGE_WORKERS'],
+            config['IMAGE_FAILURE_TTL']),
+        # every request talks to the database of one region, see SHARDS
+        'shard_router': ShardRouter(config['SHARDS'], config['SHARD_HOSTS'], config['DEFAULT_SHARD']),
+        'rate_limiter': RateLimiter(MemoryBucketStore(config['RATE_LIMIT_MAX_CLIENTS']), config['RATE_LIMITS']),
+        'admission': Admission(config['ADMISSION_MAX_IN_FLIGHT'], config['ADMISSION_MAX_POOL_WAIT'],
+                               config['ADMISSION_RETRY_AFTER']),
+        # opt-in sampling profiler, see /admin/profile
+        'profiler': StackSampler(config['PROFILE_SAMPLE_RATE'], config['PROFILE_INTERVAL']),
+        # orchestrator probes, see /readyz
+        'warmup': health.Warmup(app, [_warm_imports, _warm_templates, _warm_regions]),
+        'readiness': health.Readiness(lambda: check_databases(app, min_revision, migration_parents),
+                                      config['READY_CACHE_SECONDS']),
+    }
+    for name in ('facet_indexes', 'autocomplete', 'calendar_feeds'):
+        services[name].listen()
+    # statements slower than SLOW_QUERY_THRESHOLD go to SLOW_QUERY_LOG with their plan
+    if config['SLOW_QUERY_THRESHOLD'] is not None:
+        slowlog.SlowQueryLog(config['SLOW_QUERY_THRESHOLD'], config['SLOW_QUERY_LOG']).install()
+    app.extensions['fyyur'] = services
+
+
+#----------------------------------------------------------------------------#
+# Blueprint.
+#----------------------------------------------------------------------------#
+
+# Every route, request hook, error handler and CLI command of the app;
+# create_app() registers it on each app it builds.
+main = Blueprint('main', __name__, cli_group=None)
+
+
+# committed catalog writes are also appended to the change feed, see /changes
+changefeed.listen()
+
+# queries skip soft-deleted venues, artists and shows
+softdelete.listen()
+
+
+def enqueue_catalog_change(entity, action, **payload):
+    # Called before the commit so the job lands in the same transaction
+    payload.update(entity=entity, action=action)
+    key = payload.get('id')
+    job_queue.enqueue('catalog_changed', payload,
+                      dedup_key=f'catalog_changed:{entity}:{key}:{action}' if key else None)
+
+
+def _idempotency():
+    # (key, request fingerprint) of a create request; key is None without one
+    try:
+        key = idempotency.request_key(request)
+    except ValueError as e:
+        abort(400, str(e))
+    return key, idempotency.fingerprint(request) if key else None
+
+
+def _remember(key, request_hash, status, body):
+    if key:
+        idempotency.remember(db.session, request.endpoint, key, request_hash, status, body,
+                             current_app.config['IDEMPOTENCY_TTL'])
+
+
+def _replayed(key, request_hash):
+    # Only failed creates look the key up: a retry fails on the stored key (or
+    # on what the first request booked) and is answered like the first one
+    if not key:
+        return None
+    return idempotency.replay(db.session, request.endpoint, key, request_hash, current_app.config['IDEMPOTENCY_TTL'])
+
+
+def _replay_form(key, request_hash, respond):
+    replayed = _replayed(key, request_hash)
+    if replayed is None:
+        return None
+    status, body = replayed
+    if status >= 400:
+        flash(body['error'])
+        return render_template('pages/home.html'), status
+    flash(body['message'])
+    return respond()
+
+
+def _form_version(form):
+    # None for submissions that don't carry one; those only get the flush-time check
+    try:
+        return int(form.version.data)
+    except (TypeError, ValueError):
+        return None
+
+
+# orchestrator liveness/readiness probes, see health.py
+PROBE_ENDPOINTS = {'main.healthz', 'main.readyz'}
+
+
+@main.before_app_request
+def route_shard():
+    # the probes check every region themselves and must answer on any host
+    if request.endpoint == 'static' or request.endpoint in PROBE_ENDPOINTS:
+        return None
+    try:
+        g.shard = shard_router.resolve(request)
+    except UnknownShard:
+        abort(404)
+
+
+# Not counted by admission control: the change stream is long-lived and
+# mostly asleep, and pool_stats and the probes have to answer while the app
+# sheds load
+UNMETERED_ENDPOINTS = {'main.change_stream', 'main.pool_stats'} | PROBE_ENDPOINTS
+
+
+@main.before_app_request
+def limit_requests():
+    if request.endpoint == 'static':
+        return None
+    wait = rate_limiter.check(request.remote_addr, request.endpoint)
+    if wait:
+        return Response('Too many requests, slow down.', 429, {'Retry-After': retry_after_header(wait)})
+    if request.endpoint in UNMETERED_ENDPOINTS:
+        return None
+    if not admission.enter():
+        return Response('Server is busy, try again shortly.', 503,
+                        {'Retry-After': retry_after_header(admission.retry_after)})
+    g.admitted = True
+
+
+@main.teardown_app_request
+def release_admission(exc):
+    if g.pop('admitted', False):
+        admission.leave()
+
+
+@main.before_app_request
+def start_profile():
+    if request.endpoint and not request.endpoint.startswith('main.profile_') \
+            and request.endpoint not in PROBE_ENDPOINTS and profiler.should_sample():
+        g.profile_started = profiler.start(request.endpoint)
+
+
+@main.teardown_app_request
+def stop_profile(exc):
+    started = g.pop('profile_started', None)
+    if started is not None:
+        profiler.stop(request.endpoint, started)
+
 
 #----------------------------------------------------------------------------#
 # Controllers.
 #----------------------------------------------------------------------------#
 
-@app.route('/')
+@main.route('/')
 def index():
     return render_template('pages/home.html')
 
 
+@main.route('/autocomplete')
+def suggest_names():
+    # GET /autocomplete?q=gun&limit=10 -> venues, artists and genres starting with q
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    suggestions = autocomplete.suggest(db.session, request.args.get('q', ''), limit)
+    return jsonify({'suggestions': suggestions})
+
+
 #  Venues
 #  ----------------------------------------------------------------
 
-@app.route('/venues')
+@main.route('/venues')
 def venues():
-   
-    venues=db.session.query(Venue).join(Venue.shows).order_by('state','city', 'id').all()
-    data = [] 
+    # Rows come back ordered by state/city from a server-side cursor and are
+    # grouped on the fly, so only one area is held in memory at a time.
     now = datetime.now()
-    for i in venues:
-        venue_info = []
-        #venue_shows = Show.query.filter_by(venue_id=i.id).all()
-        num_upcoming = 0       
-        for show in i.shows:
-            if show.start_time > now:
-                num_upcoming += 1 
-        venue_info.append({
-            "id": i.id,
-            "name": i.name,
-            "num_upcoming_shows": num_upcoming
-        })
-        data.append({
-            "city": i.city,
-            "state": i.state,
-            "venues": venue_info
-        })
-        
-    return render_template('pages/venues.html', areas=data)
-
-
-@app.route('/venues/search', methods=['POST'])
+    num_upcoming = func.count(Show.id).label('num_upcoming_shows')
+    rows = db.session.query(Venue.id, Venue.name, Venue.city, Venue.state, num_upcoming) \
+        .outerjoin(Show, and_(Show.venue_id == Venue.id, Show.start_time > now)) \
+        .group_by(Venue.id) \
+        .order_by(Venue.state, Venue.city, Venue.id) \
+        .yield_per(current_app.config['LIST_STREAM_BATCH_SIZE'])
+
+    return Response(stream_template('pages/venues.html', areas=_group_venue_areas(rows)))
+
+
+def _group_venue_areas(rows):
+    for (city, state), area_rows in groupby(rows, key=lambda row: (row.city, row.state)):
+        yield {
+            "city": city,
+            "state": state,
+            "venues": [{
+                "id": row.id,
+                "name": row.name,
+                "num_upcoming_shows": row.num_upcoming_shows
+            } for row in area_rows]
+        }
+
+
+@main.route('/venues/search', methods=['POST'])
 def search_venues():
     search_term = request.form.get('search_term', '').strip()
 
-    venues = Venue.query.filter(Venue.name.ilike(f'%{search_term}%')).all()
-    venue_list = []
-    now = datetime.now()
-    for venue in venues:
-    
-        venue_list.append({
-            "id": venue.id,
-            "name": venue.name,
-
-        })
+    venues = readmodels.search(db.session, Venue, search_term)
 
     response = {
         "count": len(venues),
-        "data": venue_list
+        "data": venues
     }
 
     return render_template('pages/search_venues.html', results=response, search_term=search_term)
 
 
-@app.route('/venues/<int:venue_id>')
+@main.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
 
     data = Venue.query.filter_by(id=venue_id).first()
+    if data is None:
+        abort(404)
     #genres = [genre.name for genre in data.genres]
     
     past_shows = []
@@ -133,20 +406,90 @@ def show_venue(venue_id):
     data.upcoming_shows_count=upcoming_shows_count
     data.past_shows_count=upcoming_shows_count
     #data.genres=genres
-    data.phone=(data.phone[:3] + '-' + data.phone[3:6] + '-' + data.phone[6:])
+    similar = recommend.similar(db.session, 'venue', venue_id, current_app.config['RECOMMEND_SHOWN'])
+
+    return render_template('pages/show_venue.html', venue=data, similar=similar)
+
+@main.route('/venues/near')
+def venues_near():
+    # Upcoming shows within ?miles= of ?lat=&lon= (or ?city=&state=), nearest first
+    gazetteer = geo.load_gazetteer(current_app.config['GAZETTEER_PATH'])
+    try:
+        if 'lat' in request.args or 'lon' in request.args:
+            origin = float(request.args['lat']), float(request.args['lon'])
+        else:
+            origin = geo.geocode(gazetteer, request.args.get('city'), request.args.get('state'))
+        miles = float(request.args.get('miles', 25))
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat/lon, miles and limit must be numbers'}), 400
+    if origin is None:
+        return jsonify({'error': 'unknown location, pass lat/lon or a listed city/state'}), 400
+
+    min_lat, max_lat, lon_ranges = geo.bounding_box(origin[0], origin[1], miles)
+    rows = db.session.query(Show.id, Show.start_time, Venue.id.label('venue_id'), Venue.name.label('venue_name'),
+                            Venue.latitude, Venue.longitude,
+                            Artist.id.label('artist_id'), Artist.name.label('artist_name')) \
+        .join(Venue, Show.venue_id == Venue.id) \
+        .join(Artist, Show.artist_id == Artist.id) \
+        .filter(Venue.latitude.between(min_lat, max_lat),
+                or_(*[Venue.longitude.between(west, east) for west, east in lon_ranges]),
+                Show.start_time > datetime.now())
+
+    shows = []
+    for row in rows:
+        distance = geo.distance_miles(origin[0], origin[1], row.latitude, row.longitude)
+        if distance <= miles:
+            shows.append({
+                "show_id": row.id,
+                "start_time": row.start_time.isoformat(),
+                "venue_id": row.venue_id,
+                "venue_name": row.venue_name,
+                "artist_id": row.artist_id,
+                "artist_name": row.artist_name,
+                "distance_miles": round(distance, 1)
+            })
+    shows.sort(key=lambda show: (show['distance_miles'], show['start_time']))
+
+    return jsonify({'count': len(shows), 'shows': shows[:limit]})
+
+
+@main.route('/venues/browse')
+def browse_venues():
+    return _browse('venue', Venue, 'main.show_venue')
+
+
+@main.route('/artists/browse')
+def browse_artists():
+    return _browse('artist', Artist, 'main.show_artist')
+
+
+def _browse(kind, model, detail_endpoint):
+    # ?genre=Jazz&state=CA&seeking=yes&upcoming=yes&page=2
+    filters = {name: request.args[name] for name in FACET_ORDER if request.args.get(name)}
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['BROWSE_PAGE_SIZE']
+
+    total, ids, counts = facet_indexes.get(kind).browse(db.session, filters, (page - 1) * per_page, per_page)
+    names = dict(db.session.query(model.id, model.name).filter(model.id.in_(ids))) if ids else {}
+    results = [{"id": id, "name": names[id]} for id in ids if id in names]
+
+    return render_template('pages/browse.html', kind=kind, detail_endpoint=detail_endpoint,
+                           filters=filters, counts=counts, results=results, total=total,
+                           page=page, has_next=page * per_page < total)
 
-    return render_template('pages/show_venue.html', venue=data)
 
 #  Create Venue
 #  ----------------------------------------------------------------
 
-@app.route('/venues/create', methods=['GET'])
+@main.route('/venues/create', methods=['GET'])
 def create_venue_form():
     form = VenueForm()
+    form.idempotency_key.data = uuid.uuid4().hex
     return render_template('forms/new_venue.html', form=form)
 
 
-@app.route('/venues/create', methods=['POST'])
+@main.route('/venues/create', methods=['POST'])
 def create_venue_submission():
     form = VenueForm()
 
@@ -163,18 +506,20 @@ def create_venue_submission():
     image_link = form.image_link.data.strip()
     website = form.website.data.strip()
     facebook_link = form.facebook_link.data.strip()
+    key, request_hash = _idempotency()
+    message = 'Venue ' + request.form['name'] + ' was successfully posted!'
     
     error_in_insert=False
     try:
         added_venue = Venue(name=name, city=city, state=state, address=address, phone=phone, \
             seeking_talent=seeking_talent, seeking_description=seeking_description, image_link=image_link, \
             website=website, facebook_link=facebook_link)
-        for genre in genres:
-            genre_obj = Genre.query.filter_by(name=genre).one_or_none() 
-            if genre_obj:
-                # add_venue.genres is a list of genre objects
-                added_venue.genres.append(genre_obj)
-        db.session.add(new_venue)
+        # one query for all the genres; unknown names are left out
+        added_venue.genres = db.session.query(Genre).filter(Genre.name.in_(set(genres))).all() if genres else []
+        db.session.add(added_venue)
+        db.session.flush()
+        enqueue_catalog_change('venue', 'create', id=added_venue.id)
+        _remember(key, request_hash, 302, {'message': message})
         db.session.commit()
     except Exception as e:
         error_in_insert = True
@@ -184,25 +529,31 @@ def create_venue_submission():
         db.session.close()
     if not error_in_insert:
         # on successful db insert, flash success
-        flash('Venue ' + request.form['name'] + ' was successfully posted!')
-        return redirect(url_for('index'))
+        flash(message)
+        return redirect(url_for('main.index'))
     else:
+        replayed = _replay_form(key, request_hash, lambda: redirect(url_for('main.index')))
+        if replayed is not None:
+            return replayed
         flash('An error occurred during posting Venue ' + name )
         print("Error in create_venue_submission()")
         abort(500)
 
 
-@app.route('/venues/<venue_id>/delete', methods=['GET'])
+@main.route('/venues/<venue_id>/delete', methods=['GET'])
 def delete_venue(venue_id):
     
-    venue = Venue.query.get(venue_id)
+    venue = db.session.query(Venue).get(venue_id)
     if not venue:
         
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     else:
         error_on_delete = False
+        venue_name = venue.name
         try:
-            db.session.delete(venue)
+            # only marks it deleted; the worker archives it and its shows later
+            soft_delete(db.session, venue)
+            enqueue_catalog_change('venue', 'delete', id=venue.id)
             db.session.commit()
         except:
             error_on_delete = True
@@ -210,68 +561,50 @@ def delete_venue(venue_id):
         finally:
             db.session.close()
         if error_on_delete:
-            flash(f'An error occurred during deleting venue {venue.name}.')
+            flash(f'An error occurred during deleting venue {venue_name}.')
             print("Error in delete_venue()")
             abort(500)
         else:
             return jsonify({
                 'deleted': True,
-                'url': url_for('venues')
+                'url': url_for('main.venues')
             })
 
 
 #  Artists
 #  ----------------------------------------------------------------
-@app.route('/artists')
+@main.route('/artists')
 def artists():
-    artists = Artist.query.order_by(Artist.id).all()  # Sort alphabetically
+    # Only id and name are needed; stream them from a server-side cursor.
+    artists = db.session.query(Artist.id, Artist.name) \
+        .order_by(Artist.id) \
+        .yield_per(current_app.config['LIST_STREAM_BATCH_SIZE'])
 
-    data = []
-    for artist in artists:
-        data.append({
-            "id": artist.id,
-            "name": artist.name
-        })
+    return Response(stream_template('pages/artists.html', artists=artists))
 
 
-    return render_template('pages/artists.html', artists=data)
-
-
-@app.route('/artists/search', methods=['POST'])
+@main.route('/artists/search', methods=['POST'])
 def search_artists():
     # Most code is the same with venue_search
     search_term = request.form.get('search_term', '').strip()
 
-    artists = Artist.query.filter(Artist.name.ilike(f'%{search_term}%')).all() 
-    artist_list = []
-    now = datetime.now()
-    for artist in artists:
-        artist_shows = Show.query.filter_by(artist_id=artist.id).all()
-        num_upcoming = 0
-        for show in artist_shows:
-            if show.start_time > now:
-                num_upcoming += 1
-
-        artist_list.append({
-            "id": artist.id,
-            "name": artist.name,
-            "num_upcoming_shows": num_upcoming  
-        })
+    # upcoming show counts come from the same query instead of one per artist
+    artists = readmodels.search(db.session, Artist, search_term)
 
     response = {
         "count": len(artists),
-        "data": artist_list
+        "data": artists
     }
 
     return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
 
-@app.route('/artists/<int:artist_id>')
+@main.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
 
     data = Artist.query.filter_by(id=artist_id).first()
     if not data:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     else:
 
         past_shows = []
@@ -290,19 +623,19 @@ def show_artist(artist_id):
         data.past_shows = past_shows
         data.upcoming_shows_count=upcoming_shows_count
         data.past_shows_count=upcoming_shows_count
-        data.phone=(data.phone[:3] + '-' + data.phone[3:6] + '-' + data.phone[6:])
+        similar = recommend.similar(db.session, 'artist', artist_id, current_app.config['RECOMMEND_SHOWN'])
 
 
-    return render_template('pages/show_artist.html', artist=data)
+    return render_template('pages/show_artist.html', artist=data, similar=similar)
 
 #  Update
 #  ----------------------------------------------------------------
-@app.route('/artists/<int:artist_id>/edit', methods=['GET'])
+@main.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
 
     artist = Artist.query.get(artist_id) 
     if not artist:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     else:
 
         form = ArtistForm(obj=artist)
@@ -310,7 +643,7 @@ def edit_artist(artist_id):
     return render_template('forms/edit_artist.html', form=form, artist=artist)
 
 
-@app.route('/artists/<int:artist_id>/edit', methods=['POST'])
+@main.route('/artists/<int:artist_id>/edit', methods=['POST'])
 def edit_artist_submission(artist_id):
 #get the data from the form
     form = ArtistForm()
@@ -326,44 +659,67 @@ def edit_artist_submission(artist_id):
     website = form.website.data.strip()
     facebook_link = form.facebook_link.data.strip()
     error_in_update = False
+    conflict = False
     try:
-        artist = Artist.query.get(artist_id)
-        artist.name = name
-        artist.city = city
-        artist.state = state
-        artist.phone = phone
-        artist.seeking_venue = seeking_venue
-        artist.seeking_description = seeking_description
-        artist.image_link = image_link
-        artist.website = website
-        artist.facebook_link = facebook_link
-        artist.genres = []
-        
-        for genre in genres:
-            genre_obj = Genre.query.filter_by(name=genre).one_or_none()  
-            artist.genres.append(genre_obj)
+        artist = db.session.query(Artist).get(artist_id)
+        # flushed once bump_version() has run: one UPDATE, checked against the loaded version
+        with db.session.no_autoflush:
+            changed = update_columns(artist, {
+                "name": name,
+                "city": city,
+                "state": state,
+                "phone": phone,
+                "seeking_venue": seeking_venue,
+                "seeking_description": seeking_description,
+                "image_link": image_link,
+                "website": website,
+                "facebook_link": facebook_link
+            })
+            added, removed = sync_genres(db.session, artist, genres)
+        current_app.logger.info(f'edit artist {artist_id}: {len(changed)} column(s), genres +{added} -{removed}')
 
-        db.session.commit()
+        # nothing to write when the form was submitted unchanged
+        if changed or added or removed:
+            bump_version(artist, _form_version(form))
+            enqueue_catalog_change('artist', 'update', id=artist.id)
+            db.session.commit()
+    except StaleDataError as e:
+        conflict = True
+        current_app.logger.info(f'edit artist {artist_id}: {e}')
+        db.session.rollback()
     except Exception as e:
         error_in_update = True
         print(f'Exception "{e}" occurred in editing artist after submission')
         db.session.rollback()
     finally:
         db.session.close()
+    if conflict:
+        return _edit_conflict('artist', form, db.session.query(Artist).get(artist_id))
     if not error_in_update:
         flash('Artist ' + request.form['name'] + ' was successfully updated!')
-        return redirect(url_for('show_artist', artist_id=artist_id))
+        return redirect(url_for('main.show_artist', artist_id=artist_id))
     else:
         flash('An error occurred. Artist ' + name + ' could not be updated.')
         abort(500)
 
 
-@app.route('/venues/<int:venue_id>/edit', methods=['GET'])
+def _edit_conflict(kind, form, current):
+    # Someone saved in between: show the form again with what this user
+    # typed, now based on the current version, so submitting again overwrites
+    if current is None:
+        abort(404)
+    form.version.data = current.version
+    flash(f'{current.name} was changed by someone else while you were editing, so your changes '
+          f'were not saved. Submit the form again to save them over the other changes.')
+    return render_template(f'forms/edit_{kind}.html', form=form, **{kind: current}), 409
+
+
+@main.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
 
     venue = Venue.query.get(venue_id) 
     if not venue:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     else:
 
         form = VenueForm(obj=venue)
@@ -371,7 +727,7 @@ def edit_venue(venue_id):
     return render_template('forms/edit_venue.html', form=form, venue=venue)
 
 
-@app.route('/venues/<int:venue_id>/edit', methods=['POST'])
+@main.route('/venues/<int:venue_id>/edit', methods=['POST'])
 def edit_venue_submission(venue_id):
 
     form = VenueForm()
@@ -389,34 +745,45 @@ def edit_venue_submission(venue_id):
     website = form.website.data.strip()
     facebook_link = form.facebook_link.data.strip()
     error_in_update = False
+    conflict = False
     try:
-        venue = Venue.query.get(venue_id)
-        #Update the venue
-        venue.name = name
-        venue.city = city
-        venue.state = state
-        venue.address = address
-        venue.phone = phone
-        venue.seeking_talent = seeking_talent
-        venue.seeking_description = seeking_description
-        venue.image_link = image_link
-        venue.website = website
-        venue.facebook_link = facebook_link
-
-        venue.genres = []
-        for genre in genres:
-            genre_obj = Genre.query.filter_by(name=genre).one_or_none()                  
-            venue.genres.append(genre_obj)
-        db.session.commit()
+        venue = db.session.query(Venue).get(venue_id)
+        with db.session.no_autoflush:
+            #Update only the columns and genres that changed
+            changed = update_columns(venue, {
+                "name": name,
+                "city": city,
+                "state": state,
+                "address": address,
+                "phone": phone,
+                "seeking_talent": seeking_talent,
+                "seeking_description": seeking_description,
+                "image_link": image_link,
+                "website": website,
+                "facebook_link": facebook_link
+            })
+            added, removed = sync_genres(db.session, venue, genres)
+        current_app.logger.info(f'edit venue {venue_id}: {len(changed)} column(s), genres +{added} -{removed}')
+
+        if changed or added or removed:
+            bump_version(venue, _form_version(form))
+            enqueue_catalog_change('venue', 'update', id=venue.id)
+            db.session.commit()
+    except StaleDataError as e:
+        conflict = True
+        current_app.logger.info(f'edit venue {venue_id}: {e}')
+        db.session.rollback()
     except Exception as e:
         error_in_update = True
         print(f'Exception "{e}"  in calling edit_venue_submission()')
         db.session.rollback()
     finally:
         db.session.close()
+    if conflict:
+        return _edit_conflict('venue', form, db.session.query(Venue).get(venue_id))
     if not error_in_update:
         flash('Venue ' + request.form['name'] + ' was successfully updated!')
-        return redirect(url_for('show_venue', venue_id=venue_id))
+        return redirect(url_for('main.show_venue', venue_id=venue_id))
     else:
         flash('An error occurred. Venue ' + name + ' could not be updated.')
         abort(500)
@@ -424,13 +791,14 @@ def edit_venue_submission(venue_id):
 
 #  Create Artist
 #  ----------------------------------------------------------------
-@app.route('/artists/create', methods=['GET'])
+@main.route('/artists/create', methods=['GET'])
 def create_artist_form():
     form = ArtistForm()
+    form.idempotency_key.data = uuid.uuid4().hex
     return render_template('forms/new_artist.html', form=form)
 
 
-@app.route('/artists/create', methods=['POST'])
+@main.route('/artists/create', methods=['POST'])
 def create_artist_submission():
 
 
@@ -447,17 +815,21 @@ def create_artist_submission():
     image_link = form.image_link.data.strip()
     website = form.website.data.strip()
     facebook_link = form.facebook_link.data.strip()
+    key, request_hash = _idempotency()
+    message = 'Artist ' + request.form['name'] + ' was successfully listed!'
     error_in_insert=False
     try:
 
         added_artist = Artist(name=name, city=city, state=state, phone=phone, seeking_venue=seeking_venue, \
             seeking_description=seeking_description, image_link=image_link, \
             website=website, facebook_link=facebook_link)
-        for genre in genres:
-            genre_obj = Genre.query.filter_by(name=genre).one_or_none()  
-            added_artist.genres.append(genre_obj)
+        # one query for all the genres; unknown names are left out
+        added_artist.genres = db.session.query(Genre).filter(Genre.name.in_(set(genres))).all() if genres else []
 
         db.session.add(added_artist)
+        db.session.flush()
+        enqueue_catalog_change('artist', 'create', id=added_artist.id)
+        _remember(key, request_hash, 302, {'message': message})
         db.session.commit()
     except Exception as e:
         error_in_insert = True
@@ -466,22 +838,26 @@ def create_artist_submission():
     finally:
         db.session.close()
     if not error_in_insert:
-        flash('Artist ' + request.form['name'] + ' was successfully listed!')
-        return redirect(url_for('index'))
+        flash(message)
+        return redirect(url_for('main.index'))
     else:
+        replayed = _replay_form(key, request_hash, lambda: redirect(url_for('main.index')))
+        if replayed is not None:
+            return replayed
         flash('An error occurred. Artist ' + name + ' could not be listed.')
         abort(500)
 
-@app.route('/artists/<artist_id>/delete', methods=['GET'])
+@main.route('/artists/<artist_id>/delete', methods=['GET'])
 def delete_artist(artist_id):
-    artist = Artist.query.get(artist_id)
+    artist = db.session.query(Artist).get(artist_id)
     if not artist:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     else:
         error_on_delete = False
         artist_name = artist.name
         try:
-            db.session.delete(artist)
+            soft_delete(db.session, artist)
+            enqueue_catalog_change('artist', 'delete', id=artist.id)
             db.session.commit()
         except:
             error_on_delete = True
@@ -495,42 +871,52 @@ def delete_artist(artist_id):
         else:
             return jsonify({
                 'deleted': True,
-                'url': url_for('artists')
+                'url': url_for('main.artists')
             })
 
 
 #  Shows
 #  ----------------------------------------------------------------
 
-@app.route('/shows')
+@main.route('/shows')
 def shows():
     # displays list of shows at /shows
+    # artist and venue come from the same column-only query as light row
+    # objects, streamed to the template in batches.
+    shows = readmodels.show_tiles(db.session, current_app.config['LIST_STREAM_BATCH_SIZE'])
 
-    shows = Show.query.all()
-    data=shows
+    return Response(stream_template('pages/shows.html', shows=shows))
 
-    return render_template('pages/shows.html', shows=data)
 
-
-@app.route('/shows/create', methods=['GET'])
+@main.route('/shows/create', methods=['GET'])
 def create_shows():
     form = ShowForm()
+    form.idempotency_key.data = uuid.uuid4().hex
     return render_template('forms/new_show.html', form=form)
 
 
-@app.route('/shows/create', methods=['POST'])
+@main.route('/shows/create', methods=['POST'])
 def create_show_submission():
     form = ShowForm()
 
-    artist_id = form.artist_id.data.strip()
-    venue_id = form.venue_id.data.strip()
-    start_time = form.start_time.data
+    row = {
+        "artist_id": form.artist_id.data.strip(),
+        "venue_id": form.venue_id.data.strip(),
+        "start_time": form.start_time.data
+    }
+    key, request_hash = _idempotency()
     error_in_insert=False
+    schedule_errors = []
     try:
-        new_show = Show(start_time=start_time, artist_id=artist_id, venue_id=venue_id)
-        db.session.add(new_show)
+        for show in schedule_shows(db.session, [row], current_app.config['SHOW_SLOT_HOURS']):
+            enqueue_catalog_change('show', 'create', artist_id=show['artist_id'], venue_id=show['venue_id'])
+        _remember(key, request_hash, 200, {'message': 'Show was successfully created!'})
         db.session.commit()
-    except:
+    except ScheduleError as e:
+        error_in_insert = True
+        db.session.rollback()
+        schedule_errors = e.errors[0]['errors']
+    except Exception as e:
         error_in_insert = True
         print(f'Exception "{e}" when calling create_show_submission()')
         db.session.rollback()
@@ -538,7 +924,13 @@ def create_show_submission():
         db.session.close()
 
     if error_in_insert:
-        flash(f'An error occurred. Show could not be created.')
+        # a retry collides with the show its first attempt booked
+        replayed = _replay_form(key, request_hash, lambda: render_template('pages/home.html'))
+        if replayed is not None:
+            return replayed
+        for message in schedule_errors:
+            flash(message)
+        flash('An error occurred. Show could not be created.')
         print("Error in calling create_show_submission()")
     else:
         flash('Show was successfully created!')
@@ -546,34 +938,425 @@ def create_show_submission():
     return render_template('pages/home.html')
 
 
-@app.errorhandler(404)
+@main.route('/shows/batch', methods=['POST'])
+def create_show_batch():
+    # Body: {"shows": [{"artist_id": .., "venue_id": .., "start_time": "2026-05-21T21:30"}, ...]}
+    # Either every show is booked or none is; errors are reported per row.
+    payload = request.get_json(silent=True) or {}
+    rows = payload.get('shows')
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return jsonify({'error': '"shows" must be a list of objects'}), 400
+    key, request_hash = _idempotency()
+
+    try:
+        created = schedule_shows(db.session, rows, current_app.config['SHOW_SLOT_HOURS'])
+        for show in created:
+            enqueue_catalog_change('show', 'create', artist_id=show['artist_id'], venue_id=show['venue_id'])
+        body = {'created': len(created), 'errors': []}
+        _remember(key, request_hash, 201, body)
+        db.session.commit()
+    except ScheduleError as e:
+        db.session.rollback()
+        replayed = _replayed(key, request_hash)
+        if replayed is not None:
+            return jsonify(replayed[1]), replayed[0]
+        return jsonify({'created': 0, 'errors': e.errors}), 409
+    except Exception as e:
+        print(f'Exception "{e}" when calling create_show_batch()')
+        db.session.rollback()
+        replayed = _replayed(key, request_hash)
+        if replayed is not None:
+            return jsonify(replayed[1]), replayed[0]
+        abort(500)
+    finally:
+        db.session.close()
+
+    return jsonify(body), 201
+
+
+#  Calendar feeds
+#  ----------------------------------------------------------------
+
+@main.route('/venues/<int:venue_id>/calendar.ics')
+def venue_calendar(venue_id):
+    return _calendar('venue', venue_id)
+
+
+@main.route('/artists/<int:artist_id>/calendar.ics')
+def artist_calendar(artist_id):
+    return _calendar('artist', artist_id)
+
+
+@main.route('/genres/<int:genre_id>/calendar.ics')
+def genre_calendar(genre_id):
+    return _calendar('genre', genre_id)
+
+
+def _calendar(kind, id):
+    feed = calendar_feeds.get(db.session, kind, id, current_app.config['SHOW_SLOT_HOURS'])
+    if feed is None:
+        abort(404)
+    body, etag, last_modified = feed
+    response = Response(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['CALENDAR_MAX_AGE']
+    # answers If-None-Match / If-Modified-Since polls with an empty 304
+    return response.make_conditional(request)
+
+
+#  Images
+#  ----------------------------------------------------------------
+
+@main.route('/images/<any(venue, artist):kind>/<int:id>/<size>.jpg')
+def entity_image(kind, id, size):
+    if size not in current_app.config['IMAGE_SIZES']:
+        abort(404)
+    model = Venue if kind == 'venue' else Artist
+    link = db.session.query(model.image_link).filter(model.id == id).scalar()
+    # a miss can wait seconds on the image host; don't hold a pooled connection meanwhile
+    db.session.close()
+    if not link:
+        abort(404)
+    try:
+        path, digest = image_proxy.rendition(link, size)
+    except images.FetchError as e:
+        current_app.logger.warning(f'image of {kind} {id}: {e}')
+        abort(502)
+    except OSError as e:
+        # the cache directory is unwritable or its disk is full
+        current_app.logger.error(f'image cache: {e}')
+        abort(503)
+    # an old ?v= still gets the current image, just not for long
+    current = request.args.get('v') == images.link_version(link)
+    response = send_file(path, mimetype='image/jpeg', etag=f'{digest}-{size}', conditional=True,
+                         max_age=current_app.config['IMAGE_MAX_AGE'] if current else 300)
+    response.cache_control.public = True
+    response.cache_control.immutable = current
+    return response
+
+
+#  Change feed
+#  ----------------------------------------------------------------
+
+@main.route('/changes')
+def changes():
+    # GET /changes?since=1200&limit=500 -> catalog writes after seq 1200, oldest first
+    since = max(request.args.get('since', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), current_app.config['CHANGE_FEED_PAGE_SIZE'])
+    found = changefeed.read(db.session, since, limit)
+    return jsonify({'changes': found, 'next': found[-1]['seq'] if found else since})
+
+
+@main.route('/changes/stream')
+def change_stream():
+    # Server-sent events; resumes from Last-Event-ID, or ?since= on the first connect
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = max(request.args.get('since', 0, type=int), 0)
+    events = changefeed.stream(db.session, since, current_app.config['CHANGE_FEED_PAGE_SIZE'],
+                               current_app.config['CHANGE_FEED_POLL_INTERVAL'], current_app.config['CHANGE_FEED_STREAM_SECONDS'])
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@main.cli.command('prune-changes')
+@click.option('--days', default=None, type=int, help='Keep this many days (default CHANGE_FEED_RETENTION_DAYS).')
+@click.option('--region', default=None, help='Region shard to prune.')
+def prune_changes(days, region):
+    """Delete change feed events older than the retention period."""
+    _use_region(region)
+    days = current_app.config['CHANGE_FEED_RETENTION_DAYS'] if days is None else days
+    deleted = changefeed.prune(db.session, datetime.utcnow() - timedelta(days=days))
+    db.session.commit()
+    click.echo(f'{deleted} change(s) deleted')
+
+
+@main.cli.command('prune-idempotency-keys')
+@click.option('--region', default=None, help='Region shard to prune.')
+def prune_idempotency_keys(region):
+    """Delete idempotency keys older than IDEMPOTENCY_TTL."""
+    _use_region(region)
+    deleted = idempotency.prune(db.session, current_app.config['IDEMPOTENCY_TTL'])
+    db.session.commit()
+    click.echo(f'{deleted} key(s) deleted')
+
+
+#  Profiling
+#  ----------------------------------------------------------------
+
+def _check_profile_access():
+    # 404 while profiling is off; otherwise local requests only, or with
+    # PROFILE_TOKEN, requests sending it (the dump endpoint writes files)
+    if not profiler.sample_rate:
+        abort(404)
+    token = current_app.config['PROFILE_TOKEN']
+    if token:
+        allowed = hmac.compare_digest(request.headers.get('X-Profile-Token', '').encode(), token.encode())
+    else:
+        allowed = bool(request.remote_addr) and ipaddress.ip_address(request.remote_addr).is_loopback
+    if not allowed:
+        abort(403)
+
+
+@main.route('/admin/profile')
+def profile_report():
+    _check_profile_access()
+    return render_template('pages/profile.html', profiles=profiler.top_endpoints(),
+                           sample_rate=profiler.sample_rate, interval=profiler.interval)
+
+
+@main.route('/admin/profile/<name>.collapsed')
+def profile_collapsed(name):
+    _check_profile_access()
+    return Response(profiler.collapsed(name), mimetype='text/plain')
+
+
+@main.route('/admin/profile/<name>.speedscope.json')
+def profile_speedscope(name):
+    _check_profile_access()
+    return Response(json.dumps(profiler.speedscope(name)), mimetype='application/json',
+                    headers={'Content-Disposition': f'attachment; filename={name}.speedscope.json'})
+
+
+@main.route('/admin/profile/dump', methods=['POST'])
+def profile_dump():
+    _check_profile_access()
+    paths = profiler.dump(current_app.config['PROFILE_DIR'])
+    flash(f'Wrote {len(paths)} profile file(s) to {current_app.config["PROFILE_DIR"]}')
+    if request.form.get('reset'):
+        profiler.reset()
+    return redirect(url_for('main.profile_report'))
+
+
+#  Pool
+#  ----------------------------------------------------------------
+
+@main.route('/admin/pool')
+def pool_stats():
+    # Sampled by benchmarks/loadtest.py; no database access
+    pool = db.get_engine(bind=current_shard()).pool
+    return jsonify({
+        'pool_wait_ms': round(pool_wait.average * 1000, 3),
+        'in_flight': admission.in_flight,
+        'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+        'pool_size': pool.size() if hasattr(pool, 'size') else None,
+    })
+
+
+#  Probes
+#  ----------------------------------------------------------------
+
+def _warm_imports():
+    # babel and dateutil are imported on the first formatted date
+    format_datetime('2020-01-01T00:00:00')
+
+
+def _warm_templates():
+    for name in ('pages/home.html', 'pages/venues.html', 'pages/artists.html', 'pages/shows.html',
+                 'pages/show_venue.html', 'pages/show_artist.html'):
+        current_app.jinja_env.get_template(name)
+
+
+def _warm_regions():
+    # opens a pooled connection and builds the autocomplete index per region
+    fan_out(db, lambda session: autocomplete.suggest(session, '', 1))
+
+
+def check_databases(app, minimum, parents):
+    return {region: health.check_database(db.get_engine(app, bind=region), minimum, parents)
+            for region in list(app.config['SHARDS']) or [None]}
+
+
+@main.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+
+@main.route('/readyz')
+def readyz():
+    # The first probe starts the warmup; the instance is unready until it's done
+    warmup.start()
+    databases = readiness.database()
+    pool_ok = pool_wait.average <= current_app.config['ADMISSION_MAX_POOL_WAIT'] \
+        and admission.in_flight < admission.max_in_flight
+    ready = warmup.state == 'done' and pool_ok and not any(databases.values())
+    return jsonify({
+        'status': 'ready' if ready else 'unavailable',
+        'checks': {
+            'warmup': f'failed in {warmup.error}' if warmup.error else warmup.state,
+            'database': {region or 'default': problem or 'ok' for region, problem in databases.items()},
+            'pool': {
+                'ok': pool_ok,
+                'wait_ms': round(pool_wait.average * 1000, 3),
+                'in_flight': admission.in_flight,
+            },
+        },
+    }), 200 if ready else 503
+
+
+#  Regions
+#  ----------------------------------------------------------------
+
+@main.route('/admin/regions')
+def region_stats():
+    # Catalog size of every region shard, counted on all of them at once
+    now = datetime.now()
+
+    def count(session):
+        return {
+            'venues': session.query(func.count(Venue.id)).scalar(),
+            'artists': session.query(func.count(Artist.id)).scalar(),
+            'upcoming_shows': session.query(func.count(Show.id)).filter(Show.start_time > now).scalar(),
+        }
+
+    regions = fan_out(db, count)
+    totals = {key: sum(stats[key] for stats in regions.values())
+              for key in ('venues', 'artists', 'upcoming_shows')}
+    return jsonify({'regions': regions, 'totals': totals})
+
+
+@main.route('/admin/search')
+def search_regions():
+    # GET /admin/search?q=club -> venues and artists matching q in every region, by name
+    term = request.args.get('q', '')
+
+    def search(session):
+        return [(kind, result) for kind, model in (('venue', Venue), ('artist', Artist))
+                for result in readmodels.search(session, model, term)]
+
+    results = [{
+        "region": region,
+        "kind": kind,
+        "id": result.id,
+        "name": result.name,
+        "num_upcoming_shows": result.num_upcoming_shows,
+    } for region, found in fan_out(db, search).items() for kind, result in found]
+    results.sort(key=lambda result: (result['name'].casefold(), str(result['region']), result['kind']))
+    return jsonify({'count': len(results), 'results': results})
+
+
+@main.cli.command('slow-queries')
+@click.option('--limit', default=20, help='Number of statements to show.')
+@click.option('--rows', default=10000, help='Flag plans estimating more rows than this.')
+def slow_queries(limit, rows):
+    """Summarise the slow query log, slowest total time first."""
+    for entry in slowlog.report(current_app.config['SLOW_QUERY_LOG'], rows)[:limit]:
+        flags = [flag for flag, on in (('SEQ SCAN', entry['seq_scan']),
+                                       (f"~{entry['max_rows']} ROWS", entry['high_rows'])) if on]
+        click.echo(f"{entry['fingerprint']}  {entry['count']}x  total {entry['total_ms']:.0f}ms  "
+                   f"max {entry['max_ms']:.0f}ms  {' '.join(flags)}")
+        click.echo(f"    routes: {', '.join(sorted(entry['routes'])) or '-'}")
+        click.echo(f"    {entry['statement'][:200]}")
+
+
+#  Background jobs
+#  ----------------------------------------------------------------
+
+def _use_region(region):
+    # CLI commands work on the default database unless --region picks a shard
+    if region is not None and region not in current_app.config['SHARDS']:
+        raise click.BadParameter(f'unknown region {region!r}', param_hint='--region')
+    g.shard = region
+
+
+@main.cli.command('worker')
+@click.option('--batch-size', default=100, help='Jobs claimed per transaction.')
+@click.option('--poll-interval', default=1.0, help='Seconds to sleep when the queue is empty.')
+@click.option('--once', is_flag=True, help='Process one batch and exit.')
+@click.option('--region', default=None, help='Region shard whose queue to work on.')
+def worker(batch_size, poll_interval, once, region):
+    """Run queued background jobs; start as many as needed (one set per region)."""
+    _use_region(region)
+    processed = run_worker(job_queue, batch_size=batch_size, poll_interval=poll_interval, once=once)
+    if once:
+        click.echo(f'{processed} job(s) processed')
+
+
+def geocode_changed_venues(payloads):
+    venue_ids = [payload['id'] for payload in payloads
+                 if payload['entity'] == 'venue' and payload['action'] in ('create', 'update')]
+    if venue_ids:
+        gazetteer = geo.load_gazetteer(current_app.config['GAZETTEER_PATH'])
+        geo.geocode_venues(db.session, gazetteer, venue_ids, overwrite=True)
+
+
+CATALOG_LISTENERS.append(geocode_changed_venues)
+
+
+def purge_deleted_entities(payloads):
+    # One batch per job; `flask purge-deleted` drains larger backlogs
+    if any(payload['action'] == 'delete' for payload in payloads):
+        older_than = datetime.utcnow() - timedelta(seconds=current_app.config['PURGE_DELETED_AFTER'])
+        softdelete.purge(db.session, older_than, current_app.config['PURGE_BATCH_SIZE'])
+
+
+CATALOG_LISTENERS.append(purge_deleted_entities)
+
+
+@main.cli.command('purge-deleted')
+@click.option('--region', default=None, help='Region shard to purge.')
+def purge_deleted(region):
+    """Move soft-deleted venues, artists and shows to the archive tables."""
+    _use_region(region)
+    older_than = datetime.utcnow() - timedelta(seconds=current_app.config['PURGE_DELETED_AFTER'])
+    totals = {'venue': 0, 'artist': 0, 'show': 0}
+    while True:
+        moved = softdelete.purge(db.session, older_than, current_app.config['PURGE_BATCH_SIZE'])
+        db.session.commit()
+        if not any(moved.values()):
+            break
+        for kind, count in moved.items():
+            totals[kind] += count
+    click.echo(f"{totals['venue']} venue(s), {totals['artist']} artist(s) and {totals['show']} show(s) archived")
+
+
+@main.cli.command('build-recommendations')
+@click.option('--k', 'k', default=None, type=int, help='Neighbours kept per artist/venue (default RECOMMEND_TOP_K).')
+@click.option('--region', default=None, help='Region shard to build for.')
+def build_recommendations(k, region):
+    """Recompute the similar artists and venues shown on detail pages."""
+    _use_region(region)
+    k = current_app.config['RECOMMEND_TOP_K'] if k is None else k
+    for kind in ('artist', 'venue'):
+        written = recommend.build(db.session, kind, k, current_app.config['RECOMMEND_GENRE_WEIGHT'])
+        db.session.commit()
+        click.echo(f'{written} similar {kind} row(s) written')
+
+
+@main.cli.command('geocode-venues')
+@click.option('--all', 'overwrite', is_flag=True, help='Re-geocode venues that already have coordinates.')
+@click.option('--region', default=None, help='Region shard to geocode.')
+def geocode_venues_command(overwrite, region):
+    """Fill in venue coordinates from the bundled gazetteer."""
+    _use_region(region)
+    gazetteer = geo.load_gazetteer(current_app.config['GAZETTEER_PATH'])
+    geocoded, missing = geo.geocode_venues(db.session, gazetteer, overwrite=overwrite)
+    db.session.commit()
+    click.echo(f'{geocoded} venue(s) geocoded, {missing} not found in the gazetteer')
+
+
+@main.app_errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def server_error(error):
     return render_template('errors/500.html'), 500
 
 
-if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-    app.logger.info('errors')
-
 #----------------------------------------------------------------------------#
 # Launch.
 #----------------------------------------------------------------------------#
 
+# `flask run`, `flask worker` etc. (FLASK_APP=app) call create_app(); WSGI
+# servers load wsgi:app
+
 # Default port:
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
 
 # Or specify port manually:
 '''
@@ -0,0 +1,265 @@
+#----------------------------------------------------------------------------#
+# Search-as-you-type suggestions.
+#----------------------------------------------------------------------------#
+
+# Venue, artist and genre names are kept sorted case-insensitively as UTF-8
+# in one shared buffer, located by parallel arrays of offsets and lengths,
+# next to compact arrays for kind, id and popularity (number of upcoming
+# shows), about half the memory of a list of str (45 MiB for a million
+# names rather than 84).  A prefix maps to a contiguous slice found with two
+# binary searches, and the top-k of that slice is returned.  Results for one-
+# and two-letter prefixes, whose slices can be large, are memoised until the
+# next change.
+#
+# The index is built on first use.  Once it is older than
+# AUTOCOMPLETE_MAX_AGE (to pick up popularity drift) a background thread
+# builds a new one while requests keep using the old one, then swaps it in;
+# name changes committed meanwhile are replayed onto it first.  Name changes
+# committed through the ORM in this process are applied straight away via
+# session events.  Each region shard gets its own index.
+
+import heapq
+import threading
+import time
+from array import array
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+from model import db, Genre, Venue, Artist, Show, artist_genre_table, venue_genre_table
+from shards import current_shard, in_background
+
+KINDS = ('venue', 'artist', 'genre')
+_KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+_MODEL_KINDS = {Venue: 'venue', Artist: 'artist', Genre: 'genre'}
+
+
+def _fold(name):
+    return (name or '').casefold()
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self.text = bytearray()         # UTF-8 names; added ones are appended, removed ones stay until a rebuild
+        self.starts = array('q')        # offset in text of each name, in sorted order
+        self.lengths = array('L')
+        self.kinds = bytearray()
+        self.ids = array('l')
+        self.popularity = array('l')
+        self._short_cache = {}
+        self._lock = threading.Lock()
+
+    def load(self, entries):
+        # entries: iterable of (kind, id, name, popularity)
+        entries = sorted((entry for entry in entries if entry[2]), key=lambda entry: _fold(entry[2]))
+        encoded = [entry[2].encode() for entry in entries]
+        starts, offset = array('q'), 0
+        for data in encoded:
+            starts.append(offset)
+            offset += len(data)
+        with self._lock:
+            self.text = bytearray(b''.join(encoded))
+            self.starts = starts
+            self.lengths = array('L', (len(data) for data in encoded))
+            self.kinds = bytearray(_KIND_CODES[entry[0]] for entry in entries)
+            self.ids = array('l', (entry[1] for entry in entries))
+            self.popularity = array('l', (entry[3] for entry in entries))
+            self._short_cache = {}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def name(self, i):
+        start = self.starts[i]
+        return self.text[start:start + self.lengths[i]].decode()
+
+    def _bisect(self, key, right=False):
+        # bisect over folded names without keeping a second folded copy
+        lo, hi = 0, len(self.starts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            folded = _fold(self.name(mid))
+            if folded < key or (right and folded.startswith(key)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def add(self, kind, id, name, popularity=0):
+        if not name:
+            return
+        data = name.encode()
+        with self._lock:
+            i = self._bisect(_fold(name))
+            self.starts.insert(i, len(self.text))
+            self.lengths.insert(i, len(data))
+            self.text += data
+            self.kinds.insert(i, _KIND_CODES[kind])
+            self.ids.insert(i, id)
+            self.popularity.insert(i, popularity)
+            self._short_cache = {}
+
+    def remove(self, kind, id, name):
+        # Returns the popularity of the removed entry so a rename can keep it
+        if not name:
+            return 0
+        code, key = _KIND_CODES[kind], _fold(name)
+        with self._lock:
+            i = self._bisect(key)
+            while i < len(self.starts) and _fold(self.name(i)) == key:
+                if self.kinds[i] == code and self.ids[i] == id:
+                    popularity = self.popularity[i]
+                    del self.starts[i], self.lengths[i], self.kinds[i], self.ids[i], self.popularity[i]
+                    self._short_cache = {}
+                    return popularity
+                i += 1
+        return 0
+
+    def suggest(self, prefix, limit=10):
+        key = _fold(prefix.strip())
+        if not key:
+            return []
+        if len(key) <= 2:
+            # one read: add/remove may swap in a fresh dict at any moment
+            cached = self._short_cache.get((key, limit))
+            if cached is not None:
+                return cached
+
+        with self._lock:
+            cache = self._short_cache
+            lo = self._bisect(key)
+            hi = self._bisect(key, right=True)
+            best = heapq.nsmallest(limit, range(lo, hi), key=lambda i: (-self.popularity[i], i))
+            result = [{
+                "type": KINDS[self.kinds[i]],
+                "id": self.ids[i],
+                "name": self.name(i),
+                "upcoming_shows": self.popularity[i]
+            } for i in best]
+        if len(key) <= 2:
+            # into the dict this result was computed against; a change since dropped it
+            cache[(key, limit)] = result
+        return result
+
+
+def load_entries(session):
+    now = datetime.now()
+    for kind, model, owner in (('venue', Venue, Show.venue_id), ('artist', Artist, Show.artist_id)):
+        upcoming = dict(session.query(owner, func.count(Show.id))
+                        .filter(Show.start_time > now).group_by(owner))
+        for id, name in session.query(model.id, model.name):
+            yield kind, id, name, upcoming.get(id, 0)
+
+    # a genre is as popular as the upcoming shows of its artists and venues
+    genre_shows = {}
+    for table, owner, show_owner in ((artist_genre_table, artist_genre_table.c.artist_id, Show.artist_id),
+                                     (venue_genre_table, venue_genre_table.c.venue_id, Show.venue_id)):
+        rows = session.query(table.c.genre_id, func.count(Show.id)) \
+            .join(Show, show_owner == owner) \
+            .filter(Show.start_time > now) \
+            .group_by(table.c.genre_id)
+        for genre_id, count in rows:
+            genre_shows[genre_id] = genre_shows.get(genre_id, 0) + count
+    for id, name in session.query(Genre.id, Genre.name):
+        yield 'genre', id, name, genre_shows.get(id, 0)
+
+
+def _apply(index, change):
+    action, kind, id, old, new = change
+    popularity = index.remove(kind, id, old) if old else 0
+    if action != 'remove':
+        # a rebuild replaying the change may have read the new name already
+        popularity = max(popularity, index.remove(kind, id, new))
+        index.add(kind, id, new, popularity)
+
+
+class Autocomplete:
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.indexes = {}       # shard -> PrefixIndex
+        self.built_at = {}      # shard -> monotonic build time
+        self._rebuilding = {}   # shard -> changes committed since its rebuild started
+        self._build_lock = threading.Lock()
+
+    def _stale(self, shard):
+        return time.monotonic() - self.built_at[shard] > self.max_age
+
+    def suggest(self, session, prefix, limit=10):
+        shard = current_shard()
+        index = self.indexes.get(shard)
+        if index is None:
+            # nothing to serve until the first build
+            with self._build_lock:
+                if shard not in self.indexes:
+                    index = PrefixIndex()
+                    index.load(load_entries(session))
+                    self.indexes[shard] = index
+                    self.built_at[shard] = time.monotonic()
+            index = self.indexes[shard]
+        elif self._stale(shard):
+            with self._build_lock:
+                start = shard not in self._rebuilding and self._stale(shard)
+                if start:
+                    self._rebuilding[shard] = []
+            if start:
+                in_background(db, lambda session: self._rebuild(session, shard), 'autocomplete-rebuild')
+        return index.suggest(prefix, limit)
+
+    def _rebuild(self, session, shard):
+        try:
+            index = PrefixIndex()
+            index.load(load_entries(session))
+            with self._build_lock:
+                for change in self._rebuilding[shard]:
+                    _apply(index, change)
+                self.indexes[shard] = index
+        finally:
+            # a failed rebuild is retried once the old index is stale again
+            with self._build_lock:
+                del self._rebuilding[shard]
+                self.built_at[shard] = time.monotonic()
+
+    def listen(self):
+        # Collect name changes at flush time, apply them once committed
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        changes = session.info.setdefault('autocomplete_changes', [])
+        for obj in session.new:
+            if type(obj) in _MODEL_KINDS:
+                changes.append(('add', _MODEL_KINDS[type(obj)], obj.id, None, obj.name))
+        for obj in session.dirty:
+            if type(obj) in _MODEL_KINDS and getattr(obj, 'deleted_at', None) is not None:
+                changes.append(('remove', _MODEL_KINDS[type(obj)], obj.id, obj.name, None))
+            elif type(obj) in _MODEL_KINDS:
+                history = inspect(obj).attrs.name.history
+                if history.has_changes():
+                    old = history.deleted[0] if history.deleted else None
+                    changes.append(('rename', _MODEL_KINDS[type(obj)], obj.id, old, obj.name))
+        for obj in session.deleted:
+            if type(obj) in _MODEL_KINDS:
+                changes.append(('remove', _MODEL_KINDS[type(obj)], obj.id, obj.name, None))
+
+    def _after_commit(self, session):
+        changes = session.info.pop('autocomplete_changes', [])
+        if not changes:
+            return
+        shard = current_shard()
+        with self._build_lock:
+            index = self.indexes.get(shard)
+            if shard in self._rebuilding:
+                # the index being built may have read the rows before this commit
+                self._rebuilding[shard].extend(changes)
+        if index is None:
+            return
+        for change in changes:
+            _apply(index, change)
+
+    def _after_rollback(self, session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop('autocomplete_changes', None)
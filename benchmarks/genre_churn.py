@@ -0,0 +1,133 @@
+#----------------------------------------------------------------------------#
+# Genre edit churn benchmark.
+#----------------------------------------------------------------------------#
+
+# Saves the genres of an artist edit form two ways against a synthetic
+# SQLite catalog, and counts what each save costs the database:
+#
+#   replace   the original edit path: artist.genres = [], then one query and
+#             one append per genre name on the form
+#   sync      model.sync_genres(): one query for the form's genre ids, one
+#             for the current links, and bulk DELETE/INSERT of the difference
+#
+#   python benchmarks/genre_churn.py [--genres 200] [--linked 100] [--edits 51]
+#
+# Each edit is one of three forms: unchanged, one genre swapped for
+# another, and every genre replaced.  The report gives per save the
+# statements sent, the artist_genre rows deleted and inserted, and the
+# time taken.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+
+from app import create_app
+from model import db, Genre, Artist, artist_genre_table, sync_genres
+
+
+class BenchConfig:
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DEBUG = True
+
+
+class Counter:
+    # statements and artist_genre rows written, from the engine's point of view
+
+    def __init__(self):
+        self.statements = self.deleted = self.inserted = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        if artist_genre_table.name in statement:
+            if statement.startswith('DELETE'):
+                self.deleted += max(cursor.rowcount, 0)
+            elif statement.startswith('INSERT'):
+                self.inserted += max(cursor.rowcount, 0)
+
+
+def save_replace(artist, names):
+    artist.genres = []
+    for name in names:
+        artist.genres.append(Genre.query.filter_by(name=name).one_or_none())
+
+
+def save_sync(artist, names):
+    sync_genres(db.session, artist, names)
+
+
+def forms(rng, all_names, current, edits):
+    linked = len(current)
+    for number in range(edits):
+        kind = ('unchanged', 'one swapped', 'all replaced')[number % 3]
+        if kind == 'one swapped':
+            current = current[1:] + [rng.choice([name for name in all_names if name not in current])]
+        elif kind == 'all replaced':
+            current = rng.sample([name for name in all_names if name not in current], linked)
+        yield kind, list(current)
+
+
+def run(save, all_names, linked, edits):
+    rng = random.Random(0)
+    initial = rng.sample(all_names, linked)
+    artist = Artist(name='Churn', genres=Genre.query.filter(Genre.name.in_(initial)).all())
+    db.session.add(artist)
+    db.session.commit()
+
+    results = {}
+    counter = Counter()
+    engine = db.engine
+    event.listen(engine, 'after_cursor_execute', counter)
+    try:
+        for kind, names in forms(rng, all_names, initial, edits):
+            before = (counter.statements, counter.deleted, counter.inserted)
+            started = time.perf_counter()
+            save(artist, names)
+            db.session.commit()
+            elapsed = time.perf_counter() - started
+            totals = results.setdefault(kind, [0, 0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += counter.statements - before[0]
+            totals[2] += counter.deleted - before[1]
+            totals[3] += counter.inserted - before[2]
+            totals[4] += elapsed
+    finally:
+        event.remove(engine, 'after_cursor_execute', counter)
+    db.session.delete(artist)
+    db.session.commit()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genres', type=int, default=200)
+    parser.add_argument('--linked', type=int, default=100)
+    parser.add_argument('--edits', type=int, default=51)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'genre_churn.db')
+    BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    bench_app = create_app(BenchConfig)
+    with bench_app.app_context():
+        db.create_all()
+        all_names = [f'Genre {i}' for i in range(1, args.genres + 1)]
+        db.session.execute(Genre.__table__.insert(), [{'name': name} for name in all_names])
+        db.session.commit()
+
+        print(f'{args.genres} genres, {args.linked} linked to the artist, {args.edits} edits, per save')
+        print(f'{"":10}{"form":>14}{"statements":>12}{"deleted":>9}{"inserted":>10}{"ms":>8}')
+        for name, save in (('replace', save_replace), ('sync', save_sync)):
+            for kind, (count, statements, deleted, inserted, elapsed) in run(save, all_names, args.linked, args.edits).items():
+                print(f'{name:10}{kind:>14}{statements / count:12.1f}{deleted / count:9.1f}'
+                      f'{inserted / count:10.1f}{elapsed / count * 1000:8.2f}')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
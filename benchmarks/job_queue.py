@@ -0,0 +1,134 @@
+#----------------------------------------------------------------------------#
+# Memory job queue check.
+#----------------------------------------------------------------------------#
+
+# Builds the app with JOB_QUEUE_BACKEND = 'memory' against a throwaway
+# SQLite database and walks its queue through the life of a job:
+#
+#   enqueue       jobs land in pending, a repeated dedup_key is refused and
+#                 enqueue_catalog_change() keys its jobs by entity/id/action
+#   run           run_worker(once=True) hands each kind its payloads as one
+#                 batch and empties pending
+#   retry         a failing handler puts its jobs back with attempts + 1,
+#                 last_error set and run_at pushed out by _retry_delay()
+#   max attempts  after JOB_MAX_ATTEMPTS failures the jobs move to failed
+#
+#   python benchmarks/job_queue.py [--jobs 20] [--max-attempts 3]
+#
+# Waiting out the backoff would take minutes, so between retries the
+# check moves run_at of the pending jobs back to now.  Prints one line per
+# check and exits with status 1 if any of them fails.
+
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, enqueue_catalog_change
+from jobs import JOB_HANDLERS, MemoryQueue, _retry_delay, job, run_worker
+from model import db
+
+
+class BenchConfig:
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    JOB_QUEUE_BACKEND = 'memory'
+
+
+batches = {}
+
+
+@job('check_ok')
+def check_ok(payloads):
+    batches.setdefault('check_ok', []).append(payloads)
+
+
+@job('check_fail')
+def check_fail(payloads):
+    batches.setdefault('check_fail', []).append(payloads)
+    raise RuntimeError('handler failed')
+
+
+class Checks:
+
+    def __init__(self):
+        self.failures = 0
+
+    def __call__(self, label, ok, detail=''):
+        print(f'{"ok  " if ok else "FAIL"} {label}' + (f' ({detail})' if detail else ''))
+        if not ok:
+            self.failures += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=20)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'job_queue.db')
+    BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    BenchConfig.JOB_MAX_ATTEMPTS = args.max_attempts
+    bench_app = create_app(BenchConfig)
+    check = Checks()
+    with bench_app.app_context():
+        db.create_all()
+        queue = bench_app.extensions['fyyur']['job_queue']
+        check('memory backend', isinstance(queue, MemoryQueue), type(queue).__name__)
+        check('max attempts from config', queue.max_attempts == args.max_attempts, str(queue.max_attempts))
+
+        # enqueue
+        accepted = [queue.enqueue('check_ok', {'n': n}, dedup_key=f'ok:{n}') for n in range(args.jobs)]
+        check('enqueue', all(accepted) and len(queue.pending) == args.jobs, f'{len(queue.pending)} pending')
+        check('dedup_key refused while pending', not queue.enqueue('check_ok', {'n': 0}, dedup_key='ok:0'))
+        enqueue_catalog_change('venue', 'update', id=1)
+        enqueue_catalog_change('venue', 'update', id=1)
+        keys = [queued.dedup_key for queued in queue.pending if queued.name == 'catalog_changed']
+        check('enqueue_catalog_change dedup', keys == ['catalog_changed:venue:1:update'], repr(keys))
+
+        # run
+        processed = run_worker(queue, batch_size=args.jobs + 10, once=True)
+        check('run', processed == args.jobs + 1 and not queue.pending and not queue.failed,
+              f'{processed} processed, {len(queue.pending)} pending')
+        ok_batches = batches.get('check_ok', [])
+        check('one batch per kind', len(ok_batches) == 1 and [p['n'] for p in ok_batches[0]] == list(range(args.jobs)),
+              f'{len(ok_batches)} batch(es)')
+        check('dedup_key free after run', queue.enqueue('check_ok', {'n': 0}, dedup_key='ok:0'))
+        queue.run_once()
+
+        # retry
+        queue.enqueue('check_fail', {'n': 0})
+        queue.enqueue('check_fail', {'n': 1})
+        started = datetime.utcnow()
+        queue.run_once()
+        retried = list(queue.pending)
+        check('failed jobs back in pending', len(retried) == 2 and not queue.failed, f'{len(retried)} pending')
+        check('attempts counted', all(queued.attempts == 1 for queued in retried))
+        check('last_error kept', all('handler failed' in queued.last_error for queued in retried))
+        check('run_at backed off', all(queued.run_at >= started + _retry_delay(1) for queued in retried),
+              f'+{_retry_delay(1).total_seconds():.0f}s')
+        check('not claimed before run_at', queue.run_once() == 0)
+
+        # max attempts
+        for attempt in range(2, args.max_attempts + 1):
+            for queued in queue.pending:
+                queued.run_at = datetime.utcnow()
+            queue.run_once()
+            if attempt < args.max_attempts:
+                check(f'attempt {attempt} retried', len(queue.pending) == 2 and not queue.failed)
+        check('failed after max attempts', not queue.pending and len(queue.failed) == 2,
+              f'{len(queue.failed)} failed, attempts {[queued.attempts for queued in queue.failed]}')
+        check('handler ran once per attempt', len(batches['check_fail']) == args.max_attempts,
+              f'{len(batches["check_fail"])} run(s)')
+
+    for name in ('check_ok', 'check_fail'):
+        JOB_HANDLERS.pop(name)
+    os.remove(path)
+    print(f'{check.failures} check(s) failed' if check.failures else 'all checks passed')
+    sys.exit(1 if check.failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+#----------------------------------------------------------------------------#
+# Load test scenario runner.
+#----------------------------------------------------------------------------#
+
+# Replays a weighted traffic profile (benchmarks/scenarios/*.json) against a
+# running server with a growing number of concurrent clients, to find where
+# throughput stops growing:
+#
+#   python benchmarks/loadtest.py benchmarks/scenarios/mixed.json --url http://127.0.0.1:5000
+#   python benchmarks/loadtest.py benchmarks/scenarios/mixed.json --launch --seed
+#
+# --launch starts `flask run` with FYYUR_SETTINGS pointing at --settings
+# (benchmarks/loadtest_settings.py: a SQLite file and no rate limits, since
+# every client comes from one address); --seed fills that database with a
+# synthetic catalog first.  Point LOADTEST_DATABASE_URI at Postgres for
+# numbers that mean anything for production.
+#
+# Each client is an asyncio task with its own keep-alive HTTP/1.1
+# connection.  For every concurrency level the report gives throughput,
+# p50/p95/p99 latency, the share of requests shed (429/503) or failed, and
+# the pool wait average sampled from /admin/pool.  The ramp stops once
+# throughput grows less than --min-gain between levels, or errors or
+# shedding pass --max-error-rate.
+#
+# Profile format:
+#   name, version, description, think_time (seconds between a client's requests)
+#   params    {name: {"range": [lo, hi]} | {"choice": [...]} | {"future_days": n}}
+#   requests  [{name, weight, method, path, form | json, expect}]; "{param}"
+#             in path, form and json values is replaced per request, and
+#             expect lists the statuses that count as success (default < 400)
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Profile:
+
+    def __init__(self, path):
+        with open(path) as f:
+            spec = json.load(f)
+        self.name = spec['name']
+        self.version = spec['version']
+        self.think_time = spec.get('think_time', 0)
+        self.params = spec.get('params', {})
+        self.requests = spec['requests']
+        self.weights = [request['weight'] for request in self.requests]
+
+    def _value(self, rng, name):
+        spec = self.params[name]
+        if 'range' in spec:
+            return str(rng.randint(*spec['range']))
+        if 'choice' in spec:
+            return str(rng.choice(spec['choice']))
+        start = datetime.now() + timedelta(days=rng.uniform(1, spec['future_days']))
+        return start.replace(minute=0, second=0, microsecond=0).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _fill(self, rng, template):
+        if isinstance(template, str):
+            return template.format_map({name: self._value(rng, name) for name in self.params
+                                        if '{' + name + '}' in template})
+        if isinstance(template, dict):
+            return {key: self._fill(rng, value) for key, value in template.items()}
+        if isinstance(template, list):
+            return [self._fill(rng, value) for value in template]
+        return template
+
+    def pick(self, rng):
+        """(name, method, path, headers, body, expect) of one random request."""
+        request = rng.choices(self.requests, self.weights)[0]
+        headers, body = {}, None
+        if 'form' in request:
+            body = urlencode(self._fill(rng, request['form'])).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif 'json' in request:
+            body = json.dumps(self._fill(rng, request['json'])).encode()
+            headers['Content-Type'] = 'application/json'
+        return (request['name'], request['method'], self._fill(rng, request['path']), headers, body,
+                set(request.get('expect', ())))
+
+
+class Connection:
+    # One keep-alive HTTP/1.1 connection; reconnects when the server closes it
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, headers=None, body=None):
+        """Returns (status, body bytes)."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}',
+                 f'Content-Length: {len(body or b"")}']
+        lines += [f'{key}: {value}' for key, value in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b''))
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            response_headers[key.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            content = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            content = await self.reader.readexactly(int(response_headers['content-length']))
+        else:
+            content = await self.reader.read()
+            response_headers['connection'] = 'close'
+        if response_headers.get('connection', '').lower() == 'close' or status_line.startswith(b'HTTP/1.0'):
+            await self.close()
+        return status, content
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def sample_pool(host, port, stop, samples):
+    connection = Connection(host, port)
+    while not stop.is_set():
+        try:
+            status, content = await asyncio.wait_for(connection.request('GET', '/admin/pool'), 5)
+            if status == 200:
+                samples.append(json.loads(content))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            await connection.close()
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+    await connection.close()
+
+
+async def run_level(host, port, profile, clients, seconds, timeout, seed):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds
+    results = []        # (request name, seconds, outcome)
+
+    async def client(number):
+        rng = random.Random(seed * 100003 + number)
+        connection = Connection(host, port)
+        while loop.time() < deadline:
+            name, method, path, headers, body, expect = profile.pick(rng)
+            started = time.perf_counter()
+            try:
+                status, _ = await asyncio.wait_for(connection.request(method, path, headers, body), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                await connection.close()
+                status = None
+            elapsed = time.perf_counter() - started
+            if status in (429, 503):
+                outcome = 'shed'
+            elif status is not None and (status in expect if expect else status < 400):
+                outcome = 'ok'
+            else:
+                outcome = 'error'
+            results.append((name, elapsed, outcome))
+            if profile.think_time:
+                await asyncio.sleep(profile.think_time)
+        await connection.close()
+
+    stop, samples = asyncio.Event(), []
+    sampler = asyncio.ensure_future(sample_pool(host, port, stop, samples))
+    started = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+    return results, elapsed, samples
+
+
+def summarize(clients, results, elapsed, samples):
+    latencies = sorted(seconds for _, seconds, outcome in results if outcome == 'ok')
+    total = len(results) or 1
+    waits = [sample['pool_wait_ms'] for sample in samples]
+    return {
+        'clients': clients,
+        'requests': len(results),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'shed_rate': sum(outcome == 'shed' for _, _, outcome in results) / total,
+        'error_rate': sum(outcome == 'error' for _, _, outcome in results) / total,
+        'pool_wait_ms': max(waits) if waits else None,
+    }
+
+
+def per_route(results):
+    routes = {}
+    for name, seconds, outcome in results:
+        routes.setdefault(name, []).append((seconds, outcome))
+    for name, entries in sorted(routes.items()):
+        latencies = sorted(seconds for seconds, outcome in entries if outcome == 'ok')
+        failed = sum(outcome != 'ok' for _, outcome in entries)
+        yield name, len(entries), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, failed
+
+
+def wait_for_port(host, port, seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def seed_database(settings, shows, artists, venues):
+    # Synthetic catalog with every field the detail pages render
+    os.environ['FYYUR_SETTINGS'] = settings
+    sys.path.insert(0, ROOT)
+    from app import create_app
+    from model import db, Genre, Venue, Artist, Show, artist_genre_table, venue_genre_table
+
+    app = create_app()
+    rng = random.Random(0)
+    states = ['CA', 'NY', 'TX', 'IL', 'WA']
+    with app.app_context():
+        db.create_all()
+        if db.session.query(Show.id).first():
+            return
+        genres = ['Jazz', 'Rock n Roll', 'Blues', 'Folk', 'Hip-Hop', 'Classical']
+        db.session.execute(Genre.__table__.insert(), [{'id': i, 'name': name} for i, name in enumerate(genres, 1)])
+        db.session.execute(Venue.__table__.insert(), [
+            {'id': i, 'name': f'Venue {i} Hall', 'city': f'City {i % 50}', 'state': rng.choice(states),
+             'address': f'{i} Main St', 'phone': f'{5550000000 + i}', 'seeking_talent': i % 3 == 0}
+            for i in range(1, venues + 1)])
+        db.session.execute(Artist.__table__.insert(), [
+            {'id': i, 'name': f'Artist {i} Band', 'city': f'City {i % 50}', 'state': rng.choice(states),
+             'phone': f'{5551000000 + i}', 'seeking_venue': i % 4 == 0}
+            for i in range(1, artists + 1)])
+        db.session.execute(venue_genre_table.insert(), [
+            {'venue_id': i, 'genre_id': rng.randint(1, len(genres))} for i in range(1, venues + 1)])
+        db.session.execute(artist_genre_table.insert(), [
+            {'artist_id': i, 'genre_id': rng.randint(1, len(genres))} for i in range(1, artists + 1)])
+        now = datetime.now()
+        db.session.execute(Show.__table__.insert(), [
+            {'artist_id': rng.randint(1, artists), 'venue_id': rng.randint(1, venues),
+             'start_time': now + timedelta(hours=rng.randint(-24 * 365, 24 * 365))}
+            for _ in range(shows)])
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('profile', help='Scenario file, e.g. benchmarks/scenarios/mixed.json.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--launch', action='store_true', help='Start `flask run` on --url for the test.')
+    parser.add_argument('--settings', default=os.path.join(ROOT, 'benchmarks', 'loadtest_settings.py'))
+    parser.add_argument('--seed', action='store_true', help='Seed an empty --settings database first.')
+    parser.add_argument('--levels', default='1,2,4,8,16,32,64,128', help='Concurrent clients per step.')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each step.')
+    parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout.')
+    parser.add_argument('--min-gain', type=float, default=0.05, help='Throughput gain that counts as growth.')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--keep-going', action='store_true', help='Run every level even past saturation.')
+    parser.add_argument('--json', dest='json_path', help='Also write the report to this file.')
+    args = parser.parse_args()
+
+    profile = Profile(args.profile)
+    target = urlsplit(args.url)
+    host, port = target.hostname, target.port or 80
+
+    server = None
+    if args.launch:
+        settings = os.path.abspath(args.settings)
+        if args.seed:
+            seed_database(settings, shows=10000, artists=5000, venues=2000)
+        env = dict(os.environ, FLASK_APP='app', FYYUR_SETTINGS=settings)
+        server = subprocess.Popen([sys.executable, '-m', 'flask', 'run', '--host', host, '--port', str(port),
+                                   '--with-threads'], cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not wait_for_port(host, port, 30):
+            server.terminate()
+            sys.exit('server did not start')
+
+    print(f'profile {profile.name} v{profile.version}, {args.seconds:g}s per level, {args.url}')
+    print(f'{"clients":>8}{"requests":>10}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+          f'{"shed":>8}{"errors":>8}{"pool ms":>9}')
+    levels, best, best_results = [], None, []
+    try:
+        for number, clients in enumerate(int(level) for level in args.levels.split(',')):
+            results, elapsed, samples = asyncio.run(
+                run_level(host, port, profile, clients, args.seconds, args.timeout, number))
+            level = summarize(clients, results, elapsed, samples)
+            levels.append(level)
+            pool = '-' if level['pool_wait_ms'] is None else f'{level["pool_wait_ms"]:.1f}'
+            print(f'{clients:8}{level["requests"]:10}{level["throughput"]:9.1f}{level["p50_ms"]:9.1f}'
+                  f'{level["p95_ms"]:9.1f}{level["p99_ms"]:9.1f}{level["shed_rate"]:8.1%}'
+                  f'{level["error_rate"]:8.1%}{pool:>9}')
+
+            failing = level['error_rate'] + level['shed_rate'] > args.max_error_rate
+            growing = best is None or level['throughput'] > best['throughput'] * (1 + args.min_gain)
+            if growing and not failing:
+                best, best_results = level, results
+            elif not args.keep_going:
+                break
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print()
+    if best is None:
+        print('saturated at the first level')
+        best_results = results
+    else:
+        print(f'saturation: ~{best["clients"]} clients, {best["throughput"]:.1f} req/s, '
+              f'p99 {best["p99_ms"]:.1f} ms')
+    print(f'{"":24}{"requests":>10}{"p50 ms":>9}{"p99 ms":>9}{"failed":>8}')
+    for name, count, p50, p99, failed in per_route(best_results):
+        print(f'{name:24}{count:10}{p50:9.1f}{p99:9.1f}{failed:8}')
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'profile': profile.name, 'version': profile.version, 'levels': levels,
+                       'saturation': best}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
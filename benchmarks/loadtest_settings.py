@@ -0,0 +1,13 @@
+# Overrides for `python benchmarks/loadtest.py --launch`, loaded on top of
+# config.py through FYYUR_SETTINGS.
+import os
+import tempfile
+
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    'LOADTEST_DATABASE_URI', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'fyyur_loadtest.db'))
+
+# All clients share one address; rate limits would only measure themselves
+RATE_LIMITS = {}
+
+# Keep the log quiet, timing every statement is part of the app either way
+SLOW_QUERY_LOG = os.path.join(tempfile.gettempdir(), 'fyyur_loadtest_slow_queries.log')
@@ -0,0 +1,111 @@
+#----------------------------------------------------------------------------#
+# Read model benchmark.
+#----------------------------------------------------------------------------#
+
+# Loads the /shows list two ways from a synthetic SQLite catalog:
+#
+#   orm          Show instances with joinedload'ed Artist and Venue
+#   read models  readmodels.show_tiles() namedtuples from a column-only query
+#
+#   python benchmarks/read_models.py [--shows 100000] [--runs 3]
+#
+# The report gives rows per second and the peak Python memory (tracemalloc)
+# while the whole list is held, which is what a template loop over a
+# materialised list costs.
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import joinedload
+
+from app import create_app
+from model import db, Venue, Artist, Show
+import readmodels
+
+
+class BenchConfig:
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DEBUG = True
+
+
+def seed(shows, artists, venues):
+    db.session.execute(Artist.__table__.insert(), [
+        {'id': i, 'name': f'Artist {i}', 'image_link': f'https://img.example/a/{i}.jpg'}
+        for i in range(1, artists + 1)])
+    db.session.execute(Venue.__table__.insert(), [
+        {'id': i, 'name': f'Venue {i}', 'image_link': f'https://img.example/v/{i}.jpg'}
+        for i in range(1, venues + 1)])
+    start = datetime(2026, 1, 1)
+    db.session.execute(Show.__table__.insert(), [
+        {'artist_id': random.randint(1, artists), 'venue_id': random.randint(1, venues),
+         'start_time': start + timedelta(minutes=i)}
+        for i in range(shows)])
+    db.session.commit()
+
+
+def load_orm():
+    rows = db.session.query(Show) \
+        .options(joinedload(Show.artist), joinedload(Show.venue)) \
+        .order_by(Show.start_time, Show.id) \
+        .all()
+    for show in rows:
+        show.artist.name, show.venue.name
+    return rows
+
+
+def load_read_models():
+    rows = list(readmodels.show_tiles(db.session))
+    for show in rows:
+        show.artist.name, show.venue.name
+    return rows
+
+
+def measure(load, runs):
+    best, peak = None, 0
+    for _ in range(runs):
+        db.session.remove()
+        tracemalloc.start()
+        started = time.perf_counter()
+        rows = load()
+        elapsed = time.perf_counter() - started
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+        count = len(rows)
+        del rows
+    return count, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shows', type=int, default=100000)
+    parser.add_argument('--artists', type=int, default=5000)
+    parser.add_argument('--venues', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'read_models.db')
+    BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    bench_app = create_app(BenchConfig)
+    with bench_app.app_context():
+        db.create_all()
+        seed(args.shows, args.artists, args.venues)
+
+        print(f'{args.shows} shows, {args.artists} artists, {args.venues} venues, best of {args.runs}')
+        print(f'{"":14}{"rows":>8}{"seconds":>10}{"rows/s":>12}{"peak MiB":>11}')
+        for name, load in (('orm', load_orm), ('read models', load_read_models)):
+            count, elapsed, peak = measure(load, args.runs)
+            print(f'{name:14}{count:8}{elapsed:10.3f}{count / elapsed:12.0f}{peak / 2 ** 20:11.1f}')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#----------------------------------------------------------------------------#
+# Recommendation build benchmark.
+#----------------------------------------------------------------------------#
+
+# Builds the similarity table (recommend.build()) for a synthetic SQLite
+# catalog and times each stage:
+#
+#   python benchmarks/recommendations.py [--artists 100000] [--venues 20000] [--shows 500000]
+#
+# Artists tour mostly around a home city, so co-booking carries signal the
+# way it does in a real catalog.  The report gives seconds and peak Python
+# memory (tracemalloc, which NumPy allocations report to) for loading the
+# matrices, scoring neighbours and writing the rows, per kind, then the
+# latency of the detail page lookup (recommend.similar()).
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from model import db, Genre, Venue, Artist, Show, artist_genre_table, venue_genre_table
+import recommend
+
+
+class BenchConfig:
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DEBUG = True
+
+
+def seed(artists, venues, shows, genres, cities):
+    rng = random.Random(0)
+    db.session.execute(Genre.__table__.insert(), [{'id': i, 'name': f'Genre {i}'} for i in range(1, genres + 1)])
+    db.session.execute(Venue.__table__.insert(), [
+        {'id': i, 'name': f'Venue {i}', 'city': f'City {i % cities}', 'image_link': f'https://img.example/v/{i}.jpg'}
+        for i in range(1, venues + 1)])
+    db.session.execute(Artist.__table__.insert(), [
+        {'id': i, 'name': f'Artist {i}', 'city': f'City {i % cities}', 'image_link': f'https://img.example/a/{i}.jpg'}
+        for i in range(1, artists + 1)])
+    db.session.execute(venue_genre_table.insert(), [
+        {'venue_id': i, 'genre_id': genre}
+        for i in range(1, venues + 1) for genre in rng.sample(range(1, genres + 1), rng.randint(1, 3))])
+    db.session.execute(artist_genre_table.insert(), [
+        {'artist_id': i, 'genre_id': genre}
+        for i in range(1, artists + 1) for genre in rng.sample(range(1, genres + 1), rng.randint(1, 3))])
+
+    # venue ids by city (venue i is in city i % cities)
+    local = [list(range(city or cities, venues + 1, cities)) for city in range(cities)]
+    start = datetime(2026, 1, 1)
+    rows = []
+    for i in range(shows):
+        artist = rng.randint(1, artists)
+        if rng.random() < 0.8 and local[artist % cities]:
+            venue = rng.choice(local[artist % cities])
+        else:
+            venue = rng.randint(1, venues)
+        rows.append({'artist_id': artist, 'venue_id': venue, 'start_time': start + timedelta(minutes=i)})
+        if len(rows) == 50000:
+            db.session.execute(Show.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Show.__table__.insert(), rows)
+    db.session.commit()
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artists', type=int, default=100000)
+    parser.add_argument('--venues', type=int, default=20000)
+    parser.add_argument('--shows', type=int, default=500000)
+    parser.add_argument('--genres', type=int, default=20)
+    parser.add_argument('--cities', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--genre-weight', type=float, default=0.4)
+    parser.add_argument('--block-size', type=int, default=2000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'recommendations.db')
+    BenchConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+    bench_app = create_app(BenchConfig)
+    with bench_app.app_context():
+        db.create_all()
+        seed(args.artists, args.venues, args.shows, args.genres, args.cities)
+
+        print(f'{args.artists} artists, {args.venues} venues, {args.shows} shows, '
+              f'top {args.k}, genre weight {args.genre_weight:g}')
+        print(f'{"":8}{"stage":>12}{"seconds":>10}{"peak MiB":>11}')
+        for kind, count in (('artist', args.artists), ('venue', args.venues)):
+            (ids, masks, incidence, popularity), elapsed, peak = measure(recommend._load, db.session, kind)
+            print(f'{kind:8}{"load":>12}{elapsed:10.2f}{peak / 2 ** 20:11.1f}')
+            (best, scores), elapsed, peak = measure(recommend.neighbours, masks, incidence, popularity,
+                                                    args.k, args.genre_weight, args.block_size)
+            print(f'{kind:8}{"neighbours":>12}{elapsed:10.2f}{peak / 2 ** 20:11.1f}')
+            written, elapsed, peak = measure(recommend.build, db.session, kind, args.k,
+                                             args.genre_weight, args.block_size)
+            db.session.commit()
+            print(f'{kind:8}{"full build":>12}{elapsed:10.2f}{peak / 2 ** 20:11.1f}'
+                  f'   {written} rows, {(best[:, 0] >= 0).mean():.1%} with neighbours')
+
+            rng = random.Random(1)
+            started = time.perf_counter()
+            for _ in range(args.lookups):
+                recommend.similar(db.session, kind, rng.randint(1, count))
+            elapsed = time.perf_counter() - started
+            print(f'{kind:8}{"lookup":>12}{elapsed / args.lookups * 1000:10.3f} ms each')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#----------------------------------------------------------------------------#
+# Startup benchmark.
+#----------------------------------------------------------------------------#
+
+# Measures what a cold worker pays before serving its first request:
+#
+#   python benchmarks/startup.py [--runs 5] [--top 15]
+#
+# Each run starts a fresh interpreter with `python -X importtime -c "import wsgi"`,
+# which imports app and builds the app as a WSGI server does.  The report
+# gives the median wall time of the process, the median import time of `app`
+# alone and of `wsgi` (app plus create_app(), which loads Flask-Migrate and
+# alembic), and the modules with the largest cumulative import time in the
+# median run.  No database connection is made, since the app factory only
+# binds the engine lazily.
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def run_once():
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import wsgi'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - started
+
+    modules = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, len(indent) // 2, int(self_us), int(cumulative_us)))
+    app_us = next(cumulative for name, depth, _, cumulative in modules if name == 'app' and depth == 1)
+    wsgi_us = next(cumulative for name, depth, _, cumulative in modules if name == 'wsgi' and depth == 0)
+    return wall, app_us, wsgi_us, modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    runs = sorted((run_once() for _ in range(args.runs)), key=lambda run: run[2])
+    wall, app_us, wsgi_us, modules = runs[len(runs) // 2]
+
+    print(f'runs: {args.runs}')
+    print(f'process wall time (median): {statistics.median(run[0] for run in runs) * 1000:.1f} ms')
+    print(f'import app (median):        {statistics.median(run[1] for run in runs) / 1000:.1f} ms')
+    print(f'import wsgi (median):       {wsgi_us / 1000:.1f} ms')
+    print()
+    print(f'{"cumulative ms":>14} {"self ms":>9}  module')
+    for name, depth, self_us, cumulative_us in sorted(modules, key=lambda m: m[3], reverse=True)[:args.top]:
+        print(f'{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {"  " * depth}{name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#----------------------------------------------------------------------------#
+# iCalendar feeds.
+#----------------------------------------------------------------------------#
+
+# Upcoming shows of a venue, an artist or a genre as a text/calendar feed
+# that calendar apps can subscribe to.  Each feed comes from one query over
+# the (venue_id, start_time) / (artist_id, start_time) Show indexes; a genre
+# feed goes through artist_genre_table to the artist index.
+#
+# Calendar clients poll often, so rendered feeds are kept in an LRU cache
+# together with an ETag and Last-Modified, and a poll that hasn't missed
+# anything is answered 304 without touching the database.  Committed writes
+# to shows, venues, artists or genre links (anything model.record_changes()
+# saw) clear the cache of that region; CALENDAR_MAX_AGE bounds how long
+# another process's writes can go unnoticed.
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from model import Genre, Venue, Artist, Show, artist_genre_table
+from shards import current_shard
+
+# Entities whose changes can alter a feed
+_FEED_ENTITIES = {'show', 'venue', 'artist', 'genre', 'artist_genre'}
+
+
+def upcoming_shows(session, kind, id, limit=500):
+    query = session.query(Show.id, Show.start_time, Artist.name, Venue.name,
+                          Venue.address, Venue.city, Venue.state) \
+        .join(Artist, Show.artist_id == Artist.id) \
+        .join(Venue, Show.venue_id == Venue.id) \
+        .filter(Show.start_time > datetime.now())
+    if kind == 'venue':
+        query = query.filter(Show.venue_id == id)
+    elif kind == 'artist':
+        query = query.filter(Show.artist_id == id)
+    else:
+        query = query.join(artist_genre_table, artist_genre_table.c.artist_id == Show.artist_id) \
+            .filter(artist_genre_table.c.genre_id == id)
+    return query.order_by(Show.start_time, Show.id).limit(limit).all()
+
+
+def _escape(text):
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    # RFC 5545: lines longer than 75 octets continue on lines starting with a space
+    data = line.encode()
+    if len(data) <= 75:
+        return line
+    parts = []
+    while data:
+        cut = min(len(data), 75 if not parts else 74)
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1    # don't split a UTF-8 sequence
+        parts.append(data[:cut].decode())
+        data = data[cut:]
+    return '\r\n '.join(parts)
+
+
+def render(name, shows, slot_hours, uid_domain, stamp):
+    stamp = stamp.strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Fyyur//Upcoming shows//EN',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{_escape(name)}',
+    ]
+    for show_id, start_time, artist_name, venue_name, address, city, state in shows:
+        # start times are stored as local wall-clock times, hence floating DTSTART/DTEND
+        end_time = start_time + timedelta(hours=slot_hours)
+        location = ', '.join(part for part in (venue_name, address, city, state) if part)
+        lines += [
+            'BEGIN:VEVENT',
+            f'UID:show-{show_id}@{uid_domain}',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{start_time:%Y%m%dT%H%M%S}',
+            f'DTEND:{end_time:%Y%m%dT%H%M%S}',
+            f'SUMMARY:{_escape(f"{artist_name} at {venue_name}")}',
+            f'LOCATION:{_escape(location)}',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+class FeedCache:
+
+    def __init__(self, max_age, max_entries=1000, uid_domain='fyyur.com'):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        # event UIDs have to be the same whichever host name a feed was fetched from
+        self.uid_domain = uid_domain
+        self._feeds = OrderedDict()     # (shard, kind, id) -> (built at or None if stale, body, etag, last modified)
+        self._lock = threading.Lock()
+
+    def get(self, session, kind, id, slot_hours):
+        """(body, etag, last modified) of a feed, or None if the entity doesn't exist."""
+        key = (current_shard(), kind, id)
+        with self._lock:
+            cached = self._feeds.get(key)
+            if cached is not None and cached[0] is not None and time.monotonic() - cached[0] <= self.max_age:
+                self._feeds.move_to_end(key)
+                return cached[1:]
+
+        model = {'venue': Venue, 'artist': Artist, 'genre': Genre}[kind]
+        name = session.query(model.name).filter(model.id == id).scalar()
+        if name is None:
+            return None
+        shows = upcoming_shows(session, kind, id)
+        etag = hashlib.sha1(repr((name, slot_hours, shows)).encode()).hexdigest()
+        if cached is not None and cached[2] == etag:
+            # stale but unchanged: keep the validators so clients still get 304s
+            entry = (time.monotonic(),) + cached[1:]
+        else:
+            modified = datetime.utcnow().replace(microsecond=0)
+            entry = (time.monotonic(), render(name, shows, slot_hours, self.uid_domain, modified), etag, modified)
+        with self._lock:
+            self._feeds[key] = entry
+            self._feeds.move_to_end(key)
+            while len(self._feeds) > self.max_entries:
+                self._feeds.popitem(last=False)
+        return entry[1:]
+
+    def invalidate(self, shard=None):
+        # Marks the region's feeds stale; they keep their validators until rebuilt
+        with self._lock:
+            for key, entry in list(self._feeds.items()):
+                if key[0] == shard:
+                    self._feeds[key] = (None,) + entry[1:]
+
+    def listen(self):
+        event.listen(Session, 'after_commit', self._after_commit)
+
+    def _after_commit(self, session):
+        # record_changes() notes the entities each transaction wrote
+        if session.info.pop('changed_entities', set()) & _FEED_ENTITIES:
+            self.invalidate(current_shard())
@@ -0,0 +1,162 @@
+#----------------------------------------------------------------------------#
+# Change-data feed.
+#----------------------------------------------------------------------------#
+
+# Every committed insert, update and delete of a venue, artist, show, genre
+# or genre link is appended to the change_feed table in the same transaction
+# as the write itself (a transactional outbox).  ORM writes are captured at
+# flush time by the listener below; the bulk statements in sync_genres() and
+# schedule_shows() record their own events through model.record_changes().
+#
+# Consumers read the feed in sequence order and resume from the last seq
+# they saw, either page by page from /changes?since=N or from the
+# /changes/stream server-sent events, which sends seq as the event id.
+#
+# That only works if events become visible in seq order: a transaction that
+# took seq 10 and committed after seq 11 was read would be skipped for good.
+# So the events are not inserted as they are recorded but at commit, after
+# the last flush, and one transaction at a time: on PostgreSQL under a
+# transaction-level advisory lock, which the commit releases only once it is
+# visible; SQLite lets one transaction write at a time anyway.  The lock is
+# held for the insert and the commit only, never across a transaction's own
+# work or its row lock waits.
+
+import json
+import time
+
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.orm import Session
+
+from model import ChangeEvent, Genre, Venue, Artist, Show, record_changes
+
+# pg_advisory_xact_lock key serializing change_feed inserts
+_SEQ_LOCK = 5390251
+
+CAPTURED = {Venue: 'venue', Artist: 'artist', Show: 'show', Genre: 'genre'}
+_GENRE_LINKS = {Venue: ('venue_genre', 'venue_id'), Artist: ('artist_genre', 'artist_id')}
+
+
+def _row(obj):
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+
+def _genre_link_changes(obj):
+    link, owner_key = _GENRE_LINKS[type(obj)]
+    history = inspect(obj).attrs.genres.history
+    for op, genres in (('delete', history.deleted), ('insert', history.added)):
+        for genre in genres or ():
+            yield link, obj.id, op, {owner_key: obj.id, 'genre_id': genre.id}
+
+
+def _after_flush(session, flush_context):
+    # new/dirty/deleted and attribute history still describe this flush here
+    changes = []
+    for obj in session.new:
+        if type(obj) in CAPTURED:
+            changes.append((CAPTURED[type(obj)], obj.id, 'insert', _row(obj)))
+            if type(obj) in _GENRE_LINKS:
+                changes.extend(_genre_link_changes(obj))
+    for obj in session.dirty:
+        if type(obj) in CAPTURED:
+            if getattr(obj, 'deleted_at', None) is not None:
+                # soft delete, see softdelete.py
+                changes.append((CAPTURED[type(obj)], obj.id, 'delete', None))
+            elif session.is_modified(obj, include_collections=False):
+                changes.append((CAPTURED[type(obj)], obj.id, 'update', _row(obj)))
+            if type(obj) in _GENRE_LINKS:
+                changes.extend(_genre_link_changes(obj))
+    for obj in session.deleted:
+        if type(obj) in CAPTURED:
+            changes.append((CAPTURED[type(obj)], inspect(obj).identity[0], 'delete', None))
+    record_changes(session, changes)
+
+
+def _before_commit(session):
+    if session.transaction.nested:
+        return
+    # changes still pending in the session are recorded by this flush
+    session.flush()
+    queued = session.info.pop('change_feed', None)
+    if not queued:
+        return
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), key=_SEQ_LOCK)
+    connection.execute(ChangeEvent.__table__.insert(), [row for _, row in queued])
+
+
+def _within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+def _after_rollback(session, previous_transaction):
+    queued = session.info.get('change_feed')
+    if queued and previous_transaction.nested:
+        # a savepoint: only what was recorded inside it is gone
+        session.info['change_feed'] = [(transaction, row) for transaction, row in queued
+                                       if not _within(transaction, previous_transaction)]
+    elif queued:
+        del session.info['change_feed']
+
+
+def _after_transaction_end(session, transaction):
+    # close() ends a transaction without a rollback event
+    if transaction.parent is None:
+        session.info.pop('change_feed', None)
+
+
+def listen():
+    event.listen(Session, 'after_flush', _after_flush)
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_soft_rollback', _after_rollback)
+    event.listen(Session, 'after_transaction_end', _after_transaction_end)
+
+
+def read(session, since=0, limit=500):
+    """Events after seq `since`, oldest first, as JSON-ready dicts."""
+    rows = session.query(ChangeEvent) \
+        .filter(ChangeEvent.seq > since) \
+        .order_by(ChangeEvent.seq) \
+        .limit(limit)
+    return [{
+        "seq": row.seq,
+        "entity": row.entity,
+        "id": row.entity_id,
+        "op": row.op,
+        "data": json.loads(row.data) if row.data is not None else None,
+        "at": row.created_at.isoformat(),
+    } for row in rows]
+
+
+def stream(session, since, limit, poll_interval, max_seconds):
+    """Server-sent events from seq `since` on, for at most max_seconds.
+
+    Clients reconnect with the Last-Event-ID header to carry on.
+    """
+    deadline = time.monotonic() + max_seconds
+    yield f'retry: {int(poll_interval * 1000)}\n\n'
+    while time.monotonic() < deadline:
+        changes = read(session, since, limit)
+        # don't hold a connection while idle
+        session.close()
+        for change in changes:
+            yield f'id: {change["seq"]}\nevent: change\ndata: {json.dumps(change)}\n\n'
+        if changes:
+            since = changes[-1]['seq']
+        if len(changes) < limit:
+            # a comment line keeps proxies from closing an idle stream
+            yield ': idle\n\n'
+            time.sleep(poll_interval)
+
+
+def prune(session, older_than):
+    """Delete events created before older_than; returns how many."""
+    # the newest event always stays, or SQLite would hand its seq out again
+    newest = session.query(func.max(ChangeEvent.seq)).scalar()
+    return session.query(ChangeEvent) \
+        .filter(ChangeEvent.created_at < older_than, ChangeEvent.seq < newest) \
+        .delete(synchronize_session=False)
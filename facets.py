@@ -0,0 +1,270 @@
+#----------------------------------------------------------------------------#
+# Faceted browse.
+#----------------------------------------------------------------------------#
+
+# Each facet value (a genre, a state, seeking yes/no, upcoming shows yes/no)
+# is kept as a bitmap of artist or venue ids, using a Python int as the bit
+# set.  Filtering by several facets is an AND of their bitmaps and every
+# facet count is a popcount of (result & value bitmap), so a browse request
+# never joins or COUNTs the association tables.
+#
+# The bitmaps live in the web process.  The first browse request builds
+# them with a handful of column-only queries; once they are older than
+# FACET_MAX_AGE seconds, which picks up other processes' writes, a background
+# thread builds new ones while requests keep using the old, then swaps them
+# in.  Writes committed in this process (anything model.record_changes()
+# saw) only queue the ids they touched; the next browse request re-reads
+# just those rows and patches their bits, and ids written while a rebuild
+# runs are patched into its result before the swap.
+
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from model import db, Genre, Venue, Artist, Show, artist_genre_table, venue_genre_table
+from shards import current_shard, in_background
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    def _popcount(bitmap):
+        return bin(bitmap).count('1')
+
+FACET_ORDER = ('genre', 'state', 'seeking', 'upcoming')
+
+
+def _bitmap(ids):
+    # Setting bits one by one would copy the int each time; go through bytes
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        buf[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(buf, 'little')
+
+
+def _facts(session, kind, ids=None):
+    # ([live ids], {facet: {value: [ids]}}), of every row or only of ids
+    if kind == 'artist':
+        model, seeking, genre_table, owner = Artist, Artist.seeking_venue, artist_genre_table, artist_genre_table.c.artist_id
+        show_owner = Show.artist_id
+    else:
+        model, seeking, genre_table, owner = Venue, Venue.seeking_talent, venue_genre_table, venue_genre_table.c.venue_id
+        show_owner = Show.venue_id
+
+    rows = session.query(model.id, model.state, seeking)
+    genres = session.query(owner, Genre.name).join(Genre, Genre.id == genre_table.c.genre_id)
+    booked = session.query(show_owner).filter(Show.start_time > datetime.now()).distinct()
+    if ids is not None:
+        rows = rows.filter(model.id.in_(ids))
+        genres = genres.filter(owner.in_(ids))
+        booked = booked.filter(show_owner.in_(ids))
+
+    facets = {name: {} for name in FACET_ORDER}
+    everyone = []
+    for id, state, is_seeking in rows:
+        everyone.append(id)
+        facets['state'].setdefault(state or 'Unknown', []).append(id)
+        facets['seeking'].setdefault('yes' if is_seeking else 'no', []).append(id)
+    live = set(everyone)
+    for id, genre in genres:
+        if id in live:
+            # link rows of soft-deleted owners stay until the purge
+            facets['genre'].setdefault(genre, []).append(id)
+    upcoming = {id for id, in booked}
+    facets['upcoming'] = {
+        'yes': [id for id in everyone if id in upcoming],
+        'no': [id for id in everyone if id not in upcoming]
+    }
+    return everyone, facets
+
+
+def _load(session, kind):
+    everyone, facets = _facts(session, kind)
+    bitmaps = {name: {value: _bitmap(ids) for value, ids in values.items()} for name, values in facets.items()}
+    return _bitmap(everyone), bitmaps
+
+
+def _patch(session, kind, state, ids):
+    # state with the bits of ids replaced by what the database says now
+    built_at, everyone, bitmaps = state
+    found, facets = _facts(session, kind, ids)
+    clear = ~_bitmap(ids)
+    patched = {}
+    for name in FACET_ORDER:
+        values = {value: bitmap & clear for value, bitmap in bitmaps[name].items()}
+        for value, value_ids in facets[name].items():
+            values[value] = values.get(value, 0) | _bitmap(value_ids)
+        # values nobody has any more drop out of the counts
+        patched[name] = {value: bitmap for value, bitmap in values.items() if bitmap}
+    return built_at, (everyone & clear) | _bitmap(found), patched
+
+
+class FacetIndex:
+
+    def __init__(self, kind, max_age):
+        self.kind = kind
+        self.max_age = max_age
+        self._state = None          # (built at, all ids bitmap, {facet: {value: bitmap}})
+        self._changed = set()       # ids written since, patched in by the next browse
+        self._rebuilt_ids = None    # ids written since the running rebuild started, if one is
+        self._invalidated = False
+        self._lock = threading.Lock()
+        self._changed_lock = threading.Lock()
+
+    def invalidate(self):
+        # rebuilt in the background like a stale index; served as is meanwhile
+        self._invalidated = True
+
+    def changed(self, ids):
+        with self._changed_lock:
+            self._changed.update(ids)
+            if self._rebuilt_ids is not None:
+                self._rebuilt_ids.update(ids)
+
+    def _current(self, session):
+        state = self._state
+        if state is None:
+            # nothing to serve until the first build
+            with self._lock:
+                if self._state is None:
+                    self._state = (time.monotonic(),) + _load(session, self.kind)
+        elif self._invalidated or time.monotonic() - state[0] > self.max_age:
+            self._start_rebuild()
+        if self._changed:
+            with self._lock:
+                with self._changed_lock:
+                    ids, self._changed = self._changed, set()
+                if ids:
+                    # also after a build, which may have read them from before their commit
+                    self._state = _patch(session, self.kind, self._state, ids)
+        return self._state
+
+    def _start_rebuild(self):
+        with self._changed_lock:
+            if self._rebuilt_ids is not None:
+                return
+            self._rebuilt_ids = set()
+            self._invalidated = False
+        in_background(db, self._rebuild, f'{self.kind}-facets-rebuild')
+
+    def _rebuild(self, session):
+        try:
+            state = (time.monotonic(),) + _load(session, self.kind)
+            with self._lock:
+                with self._changed_lock:
+                    ids, self._rebuilt_ids = self._rebuilt_ids, None
+                if ids:
+                    state = _patch(session, self.kind, state, ids)
+                self._state = state
+        except Exception:
+            # keep serving the old bitmaps; the next try is FACET_MAX_AGE away
+            with self._lock:
+                self._state = (time.monotonic(),) + self._state[1:]
+            with self._changed_lock:
+                self._rebuilt_ids = None
+            raise
+
+    def browse(self, session, filters, offset=0, limit=50):
+        """Apply {facet: value} filters.
+
+        Returns (total, ids on this page, {facet: {value: count}}), where
+        the counts already take the filters on the other facets into account.
+        """
+        _, everyone, bitmaps = self._current(session)
+        selected = {name: bitmaps[name].get(value, 0) for name, value in filters.items() if name in bitmaps}
+
+        result = everyone
+        for bitmap in selected.values():
+            result &= bitmap
+
+        counts = {}
+        for name in FACET_ORDER:
+            # counts for a facet ignore its own filter so other values stay reachable
+            base = everyone
+            for other, bitmap in selected.items():
+                if other != name:
+                    base &= bitmap
+            counts[name] = {value: _popcount(base & bitmap) for value, bitmap in sorted(bitmaps[name].items())}
+
+        return _popcount(result), _page_ids(result, offset, limit), counts
+
+
+# Bits of a result bitmap looked at per step when paging
+_PAGE_CHUNK = 1 << 14
+
+
+def _page_ids(bitmap, offset, limit):
+    # Walks the set bits from id 0 up a chunk at a time, skipping whole chunks
+    # by their popcount, and stops once the page is full
+    ids = []
+    mask = (1 << _PAGE_CHUNK) - 1
+    base, end = 0, bitmap.bit_length()
+    while base < end and len(ids) < limit:
+        chunk = (bitmap & (mask << base)) >> base
+        count = _popcount(chunk)
+        if offset >= count:
+            offset -= count
+        else:
+            bits = bin(chunk)[:1:-1]     # least significant bit first
+            i = bits.find('1')
+            while i != -1 and len(ids) < limit:
+                if offset:
+                    offset -= 1
+                else:
+                    ids.append(base + i)
+                i = bits.find('1', i + 1)
+        base += _PAGE_CHUNK
+    return ids
+
+
+class FacetIndexes:
+    """One FacetIndex per (region shard, kind), kept current by committed writes."""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._indexes = {}
+
+    def get(self, kind):
+        key = (current_shard(), kind)
+        if key not in self._indexes:
+            self._indexes[key] = FacetIndex(kind, self.max_age)
+        return self._indexes[key]
+
+    def listen(self):
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def _after_commit(self, session):
+        # no SQL can run here; the ids are re-read by the next browse request
+        rows = session.info.pop('changed_rows', [])
+        changed = {'artist': set(), 'venue': set()}
+        rebuild = False
+        for entity, id, data in rows:
+            if entity in changed:
+                changed[entity].add(id)
+            elif entity in ('artist_genre', 'venue_genre'):
+                changed[entity.split('_')[0]].add(id)
+            elif entity == 'show' and data is not None:
+                changed['artist'].add(data['artist_id'])
+                changed['venue'].add(data['venue_id'])
+            elif entity == 'genre':
+                # a renamed genre moves everyone filed under it
+                rebuild = True
+        shard = current_shard()
+        for kind, ids in changed.items():
+            index = self._indexes.get((shard, kind))
+            if index is None:
+                continue
+            if rebuild:
+                index.invalidate()
+            if ids:
+                index.changed(ids)
+
+    def _after_rollback(self, session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop('changed_rows', None)
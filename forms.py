@@ -1,6 +1,6 @@
 from datetime import datetime
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, HiddenField
 from wtforms.validators import DataRequired, AnyOf, URL, Optional
 
 class ShowForm(FlaskForm):
@@ -15,6 +15,8 @@ class ShowForm(FlaskForm):
         validators=[DataRequired()],
         default= datetime.today()
     )
+    # retries of the same submission create one show, see idempotency.py
+    idempotency_key = HiddenField()
 
 class VenueForm(FlaskForm):
     name = StringField(
@@ -128,6 +130,9 @@ class VenueForm(FlaskForm):
     facebook_link = StringField(
         'facebook_link', validators=[Optional(), URL()]
     )
+    idempotency_key = HiddenField()
+    # version the edit form was rendered from, see model.bump_version()
+    version = HiddenField()
 
 class ArtistForm(FlaskForm):
     name = StringField(
@@ -237,4 +242,6 @@ class ArtistForm(FlaskForm):
     )
     facebook_link = StringField(
         'facebook_link', validators=[Optional(), URL()]    # Can chain these
-    )
\ No newline at end of file
+    )
+    idempotency_key = HiddenField()
+    version = HiddenField()
@@ -0,0 +1,89 @@
+#----------------------------------------------------------------------------#
+# Venue geocoding and distance search.
+#----------------------------------------------------------------------------#
+
+# Venues are geocoded offline from a bundled gazetteer (data/gazetteer.csv,
+# one row per city/state with its centroid), so no network call is ever
+# made.  Any larger gazetteer with the same columns can be dropped in via
+# the GAZETTEER_PATH setting.
+#
+# "Near" queries first cut the venues down with a latitude/longitude
+# bounding box, which the (latitude, longitude) B-tree index on Venue can
+# answer on both Postgres and SQLite, and only compute exact great-circle
+# distances for the rows inside the box.  A box crossing the antimeridian
+# is split in two longitude ranges, one on each side of it.
+
+import csv
+from functools import lru_cache
+from math import asin, cos, radians, sin, sqrt
+
+from model import Venue
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LATITUDE = 69.0
+
+
+def _place_key(city, state):
+    return ' '.join((city or '').lower().split()), (state or '').strip().upper()
+
+
+@lru_cache(maxsize=None)
+def load_gazetteer(path):
+    with open(path, newline='') as f:
+        return {
+            _place_key(row['city'], row['state']): (float(row['latitude']), float(row['longitude']))
+            for row in csv.DictReader(f)
+        }
+
+
+def geocode(gazetteer, city, state):
+    # (latitude, longitude) of the city centroid, or None if it isn't listed
+    return gazetteer.get(_place_key(city, state))
+
+
+def bounding_box(latitude, longitude, miles):
+    """(min latitude, max latitude, [(min longitude, max longitude), ...]) around a point.
+
+    There are two longitude ranges when the box crosses the antimeridian.
+    """
+    lat_delta = miles / MILES_PER_DEGREE_LATITUDE
+    min_lat, max_lat = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    # Degrees of longitude shrink towards the poles, and a box reaching a pole
+    # takes in every longitude
+    lon_delta = miles / (MILES_PER_DEGREE_LATITUDE * max(cos(radians(latitude)), 0.01))
+    if min_lat <= -90.0 or max_lat >= 90.0 or lon_delta >= 180.0:
+        return min_lat, max_lat, [(-180.0, 180.0)]
+    west, east = longitude - lon_delta, longitude + lon_delta
+    if west < -180.0:
+        return min_lat, max_lat, [(west + 360.0, 180.0), (-180.0, east)]
+    if east > 180.0:
+        return min_lat, max_lat, [(west, 180.0), (-180.0, east - 360.0)]
+    return min_lat, max_lat, [(west, east)]
+
+
+def distance_miles(lat1, lon1, lat2, lon2):
+    # Haversine formula
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * asin(sqrt(a))
+
+
+def geocode_venues(session, gazetteer, venue_ids=None, overwrite=False):
+    """Fill in latitude/longitude from the gazetteer; returns (geocoded, not found)."""
+    query = session.query(Venue)
+    if venue_ids is not None:
+        query = query.filter(Venue.id.in_(venue_ids))
+    if not overwrite:
+        query = query.filter(Venue.latitude.is_(None))
+
+    geocoded = missing = 0
+    for venue in query:
+        point = geocode(gazetteer, venue.city, venue.state)
+        if point is None:
+            # an edit to an unlisted city must not leave the venue "near" its old one
+            venue.latitude = venue.longitude = None
+            missing += 1
+            continue
+        venue.latitude, venue.longitude = point
+        geocoded += 1
+    return geocoded, missing
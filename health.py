@@ -0,0 +1,134 @@
+#----------------------------------------------------------------------------#
+# Health and readiness probes.
+#----------------------------------------------------------------------------#
+
+# /healthz only says the process can run a request; it does no I/O.
+# /readyz says whether this instance should be sent traffic:
+#
+#   warmup     the warmup steps (lazy imports, templates, a pooled connection
+#              and the autocomplete index per region) have finished, so
+#              the first real requests don't pay for them
+#   database   every region's database answers, and its alembic revision is
+#              READY_MIN_REVISION or a later one, by default the head of
+#              migrations/versions
+#   pool       connection checkouts aren't queueing, the same signal
+#              admission control sheds load on
+#
+# Probes arrive every few seconds from every orchestrator, so the database
+# check, the only one doing I/O, is cached for READY_CACHE_SECONDS and only
+# one probe at a time refreshes it.  The revision check reads the migration
+# scripts instead of importing alembic, which web workers never load.
+
+import glob
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import text
+
+_REVISION = re.compile(r"^(revision|down_revision) = (?:'([0-9a-f]+)'|None)", re.M)
+
+
+def revision_parents(versions_dir):
+    """{revision: down_revision or None} of the migration scripts in versions_dir."""
+    parents = {}
+    for path in glob.glob(os.path.join(versions_dir, '*.py')):
+        with open(path) as f:
+            found = dict(_REVISION.findall(f.read()))
+        if found.get('revision'):
+            parents[found['revision']] = found.get('down_revision') or None
+    return parents
+
+
+def head(parents):
+    """The one revision no other revision follows, or None if the scripts have several heads."""
+    heads = set(parents) - set(parents.values())
+    return heads.pop() if len(heads) == 1 else None
+
+
+def at_least(revision, minimum, parents):
+    # A revision this code doesn't know was migrated ahead of a rolling
+    # deploy, so it counts as later too
+    if revision not in parents:
+        return True
+    while revision is not None:
+        if revision == minimum:
+            return True
+        revision = parents.get(revision)
+    return False
+
+
+def check_database(engine, minimum, parents):
+    """None if the database answers and is migrated far enough, else what's wrong."""
+    try:
+        connection = engine.connect()
+    except Exception as e:
+        return f'unreachable: {e.__class__.__name__}'
+    try:
+        with connection:
+            revisions = [revision for revision, in connection.execute(text('SELECT version_num FROM alembic_version'))]
+    except Exception as e:
+        return f'cannot read alembic_version: {e.__class__.__name__}'
+    if not revisions:
+        return 'not migrated'
+    if minimum is None:
+        return 'migrations have several heads'
+    behind = [revision for revision in revisions if not at_least(revision, minimum, parents)]
+    if behind:
+        return f'revision {behind[0]} is older than {minimum}'
+    return None
+
+
+class Readiness:
+
+    def __init__(self, check, max_age):
+        self.check = check              # () -> {region: problem or None}
+        self.max_age = max_age
+        self._result = None             # (monotonic time, check() result)
+        self._refreshing = threading.Lock()
+
+    def database(self):
+        result = self._result
+        if result is not None and time.monotonic() - result[0] <= self.max_age:
+            return result[1]
+        # probes arriving while another refreshes get the previous result
+        if not self._refreshing.acquire(blocking=result is None):
+            return result[1]
+        try:
+            if self._result is result:
+                self._result = (time.monotonic(), self.check())
+            return self._result[1]
+        finally:
+            self._refreshing.release()
+
+
+class Warmup:
+
+    def __init__(self, app, steps):
+        self.app = app
+        self.steps = steps              # callables run in order inside an app context
+        self.state = 'pending'          # pending, running, done or failed
+        self.error = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Runs the steps in a background thread; after a failure the next call retries
+        with self._lock:
+            if self.state in ('running', 'done'):
+                return
+            self.state = 'running'
+            self.error = None
+        threading.Thread(target=self._run, name='warmup', daemon=True).start()
+
+    def _run(self):
+        try:
+            with self.app.app_context():
+                for step in self.steps:
+                    step()
+        except Exception as e:
+            self.error = f'{getattr(step, "__name__", step)}: {e.__class__.__name__}: {e}'
+            self.state = 'failed'
+            self.app.logger.warning(f'warmup failed in {self.error}')
+        else:
+            self.state = 'done'
@@ -0,0 +1,74 @@
+#----------------------------------------------------------------------------#
+# Idempotent creates.
+#----------------------------------------------------------------------------#
+
+# Clients (and proxies) may retry POSTs to the create endpoints.  A request
+# that carries an Idempotency-Key header, or the idempotency_key field the
+# create forms render, stores its response under that key in the same
+# transaction as the rows it created.  A retry with the key then fails to
+# store it again (primary key), rolls back, and is answered from the stored
+# response instead of creating a duplicate.
+#
+# The first request pays one INSERT and no extra read; only a failed
+# request looks the key up.  Keys expire after IDEMPOTENCY_TTL seconds and
+# `flask prune-idempotency-keys` deletes them.
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_
+
+from model import IdempotencyKey
+
+MAX_KEY_LENGTH = 200
+
+_table = IdempotencyKey.__table__
+
+
+def request_key(request):
+    """The request's idempotency key, or None; over-long keys raise ValueError."""
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    if key and len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f'idempotency keys are at most {MAX_KEY_LENGTH} characters')
+    return key or None
+
+
+def fingerprint(request):
+    # what a retry has to repeat; the CSRF token may be re-rendered
+    form = sorted((name, value) for name, value in request.form.items(multi=True) if name != 'csrf_token')
+    return hashlib.sha1(repr((form, request.get_json(silent=True))).encode()).hexdigest()
+
+
+def remember(session, endpoint, key, request_hash, status, body, ttl):
+    """Store the response to this key's first request, in the caller's transaction."""
+    expired = datetime.utcnow() - timedelta(seconds=ttl)
+    # an expired key may be used again
+    session.execute(_table.delete().where(and_(_table.c.endpoint == endpoint, _table.c.key == key,
+                                               _table.c.created_at < expired)))
+    session.execute(_table.insert(), {'endpoint': endpoint, 'key': key, 'request_hash': request_hash,
+                                      'status': status, 'body': json.dumps(body),
+                                      'created_at': datetime.utcnow()})
+
+
+def replay(session, endpoint, key, request_hash, ttl):
+    """(status, body) stored for an earlier request with this key, or None.
+
+    A key sent again with a different request is answered 422.
+    """
+    stored = session.query(IdempotencyKey) \
+        .filter(IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key,
+                IdempotencyKey.created_at >= datetime.utcnow() - timedelta(seconds=ttl)) \
+        .one_or_none()
+    if stored is None:
+        return None
+    if stored.request_hash != request_hash:
+        return 422, {'error': 'Idempotency key was already used for a different request.'}
+    return stored.status, json.loads(stored.body)
+
+
+def prune(session, ttl):
+    """Delete expired keys; returns how many."""
+    return session.query(IdempotencyKey) \
+        .filter(IdempotencyKey.created_at < datetime.utcnow() - timedelta(seconds=ttl)) \
+        .delete(synchronize_session=False)
@@ -0,0 +1,375 @@
+#----------------------------------------------------------------------------#
+# Venue and artist image proxy.
+#----------------------------------------------------------------------------#
+
+# image_link points at full-size pictures on other hosts, which list and
+# detail pages used to embed as is.  /images/<kind>/<id>/<size>.jpg serves
+# them resized to IMAGE_SIZES instead:
+#
+#   fetch      each source URL is downloaded once, however many requests miss
+#              on it at the same time, and failures are remembered for
+#              IMAGE_FAILURE_TTL so a dead host isn't hammered
+#   resize     Pillow decodes and scales the image to every size at once in a
+#              small thread pool (it releases the GIL while it works), so a
+#              burst of misses can't take every request thread
+#   cache      renditions are stored on disk named by the sha256 of the source
+#              bytes, so the same picture linked twice is stored once, and the
+#              least recently used are deleted past IMAGE_CACHE_MAX_BYTES
+#
+# Image URLs carry ?v= from the image_link they were rendered for, so they
+# can be cached by browsers for a year: editing the link changes the URL.
+# IMAGE_ORIGIN replaces the scheme and host of every link, to fetch from a
+# mirror or from a local stand-in server in tests.
+#
+# image_link is whatever a visitor typed into a form, so without IMAGE_ORIGIN
+# the proxy only connects to public addresses: the host is resolved, every
+# address it resolves to is checked, and the socket connects to the checked
+# address.  The check sits in the connection rather than before the request,
+# so it also covers each redirect and a DNS answer that changes in between.
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from io import BytesIO
+from urllib.parse import urlsplit
+from urllib.request import (HTTPDefaultErrorHandler, HTTPErrorProcessor, HTTPHandler, HTTPRedirectHandler,
+                            HTTPSHandler, OpenerDirector, Request, UnknownHandler, urlopen)
+
+
+class FetchError(Exception):
+    pass
+
+
+def link_version(link):
+    # ?v= of the image URLs rendered for link
+    return hashlib.sha1(link.encode()).hexdigest()[:12]
+
+
+def source_url(link, origin=None):
+    if not origin:
+        return link
+    parts = urlsplit(link)
+    return origin.rstrip('/') + (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+
+
+def _is_public(address):
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def _connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    # socket.create_connection, refusing loopback, private, link-local and
+    # reserved addresses
+    host, port = address
+    try:
+        found = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise FetchError(f'cannot resolve {host}: {e}') from e
+    for *_, sockaddr in found:
+        if not _is_public(sockaddr[0]):
+            raise FetchError(f'{host} resolves to {sockaddr[0]}, which is not a public address')
+    error = None
+    for family, kind, proto, _, sockaddr in found:
+        sock = socket.socket(family, kind, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPHandler(HTTPHandler):
+
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPConnection, req, **kwargs)
+
+
+class _PublicHTTPSHandler(HTTPSHandler):
+
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(_PublicHTTPSConnection, req, **kwargs)
+
+
+def _public_opener():
+    # http(s) and redirects between them only: no proxies from the
+    # environment, and no ftp: or file: handlers for a redirect to reach
+    opener = OpenerDirector()
+    for handler in (_PublicHTTPHandler(), _PublicHTTPSHandler(), HTTPRedirectHandler(),
+                    HTTPDefaultErrorHandler(), HTTPErrorProcessor(), UnknownHandler()):
+        opener.add_handler(handler)
+    return opener
+
+
+_public = _public_opener()
+
+
+def fetch(url, timeout, max_bytes, public_only=True):
+    """The bytes of the image at url; raises FetchError for anything else.
+
+    With public_only, only hosts at public addresses are contacted, redirects
+    included.
+    """
+    if urlsplit(url).scheme not in ('http', 'https'):
+        raise FetchError(f'not an http(s) URL: {url}')
+    request = Request(url, headers={'User-Agent': 'fyyur-image-proxy'})
+    try:
+        with (_public.open if public_only else urlopen)(request, timeout=timeout) as response:
+            content_type = response.headers.get_content_type()
+            if not content_type.startswith('image/'):
+                raise FetchError(f'{url} is {content_type}, not an image')
+            data = response.read(max_bytes + 1)
+    except OSError as e:    # URLError, HTTPError and timeouts
+        raise FetchError(f'{url}: {e}') from e
+    if len(data) > max_bytes:
+        raise FetchError(f'{url} is larger than {max_bytes} bytes')
+    return data
+
+
+def render(data, sizes, quality=82):
+    """{size name: JPEG bytes} of the image in data scaled to fit each (width, height)."""
+    # Pillow is imported by the first resize, not by every worker and CLI
+    # command at startup
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            # JPEGs can be decoded straight at a fraction of their size
+            image.draft('RGB', (max(w for w, h in sizes.values()), max(h for w, h in sizes.values())))
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                # transparent pixels go white rather than black
+                rgba = image.convert('RGBA')
+                image = Image.new('RGB', rgba.size, 'white')
+                image.paste(rgba, mask=rgba.getchannel('A'))
+            renditions = {}
+            for name, box in sizes.items():
+                scaled = image.copy()
+                scaled.thumbnail(box, Image.LANCZOS)
+                out = BytesIO()
+                scaled.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+                renditions[name] = out.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise FetchError(f'cannot decode image: {e}') from e
+    return renditions
+
+
+class DiskCache:
+    """Content-addressed renditions under directory, least recently used out first.
+
+    Each process keeps the recency order in memory, seeded from file mtimes at
+    start, and adopts files other processes wrote when it first sees them.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()     # path -> (bytes, mtime), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        # Scanned on first use rather than at import, which CLI commands also do
+        os.makedirs(os.path.join(self.directory, 'links'), exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and len(entry.name) == 2:
+                for file in os.scandir(entry.path):
+                    if file.name.endswith('.jpg'):
+                        stat = file.stat()
+                        found.append((stat.st_mtime, file.path, stat.st_size))
+        with self._lock:
+            if not self._loaded:
+                for mtime, path, size in sorted(found):
+                    self._files[path] = (size, mtime)
+                    self._bytes += size
+                self._loaded = True
+
+    def path(self, digest, size):
+        return os.path.join(self.directory, digest[:2], f'{digest}-{size}.jpg')
+
+    def _link_path(self, url):
+        return os.path.join(self.directory, 'links', hashlib.sha256(url.encode()).hexdigest())
+
+    def digest(self, url):
+        # sha256 of the bytes last fetched from url, or None
+        if not self._loaded:
+            self._load()
+        try:
+            with open(self._link_path(url)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def get(self, digest, size):
+        """Path of a rendition, or None if it isn't cached."""
+        path = self.path(digest, size)
+        with self._lock:
+            cached = self._files.get(path)
+        if cached is None:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            # written by another process
+            with self._lock:
+                cached = self._files.get(path)
+                if cached is None:
+                    cached = self._files[path] = (stat.st_size, stat.st_mtime)
+                    self._bytes += stat.st_size
+        elif not os.path.exists(path):
+            # evicted by another process
+            with self._lock:
+                if self._files.pop(path, None) is not None:
+                    self._bytes -= cached[0]
+            return None
+        now = time.time()
+        if now - cached[1] > 3600:
+            # mtime is the recency order the next process starts from; touch it hourly at most
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            cached = (cached[0], now)
+        with self._lock:
+            if path in self._files:
+                self._files[path] = cached
+                self._files.move_to_end(path)
+        return path
+
+    def has(self, digest, sizes):
+        return all(self.get(digest, size) for size in sizes)
+
+    def put(self, url, digest, renditions):
+        """Store {size: bytes} renditions of digest and point url at it."""
+        os.makedirs(os.path.join(self.directory, digest[:2]), exist_ok=True)
+        for size, data in renditions.items():
+            path = self.path(digest, size)
+            _write(path, data)
+            with self._lock:
+                previous = self._files.pop(path, None)
+                self._bytes += len(data) - (previous[0] if previous else 0)
+                self._files[path] = (len(data), time.time())
+        _write(self._link_path(url), digest.encode())
+        self._evict()
+
+    def _evict(self):
+        doomed = []
+        with self._lock:
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                path, (size, _) = self._files.popitem(last=False)
+                self._bytes -= size
+                doomed.append(path)
+        for path in doomed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _write(path, data):
+    # readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class ImageProxy:
+
+    def __init__(self, cache, sizes, origin=None, timeout=10, max_bytes=10 * 2 ** 20,
+                 quality=82, workers=2, failure_ttl=300):
+        self.cache = cache
+        self.sizes = sizes              # {name: (width, height)}
+        self.origin = origin
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.failure_ttl = failure_ttl
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='images')
+        self._pending = {}              # url -> Future of its digest
+        self._failures = {}             # url -> (monotonic time, FetchError)
+        self._lock = threading.Lock()
+
+    def rendition(self, link, size):
+        """(path, digest) of link's image at size, fetched and resized on a miss.
+
+        Raises FetchError if the image can't be fetched or decoded.
+        """
+        url = source_url(link, self.origin)
+        digest = self.cache.digest(url)
+        path = digest and self.cache.get(digest, size)
+        if path:
+            return path, digest
+
+        with self._lock:
+            failed = self._failures.get(url)
+            if failed is not None and time.monotonic() - failed[0] < self.failure_ttl:
+                raise failed[1]
+            # concurrent misses on one URL share a single fetch
+            future = self._pending.get(url)
+            if future is None:
+                future = self._pending[url] = self._pool.submit(self._build, url)
+                started = True
+            else:
+                started = False
+        if started:
+            future.add_done_callback(lambda done: self._finished(url, done))
+        try:
+            digest = future.result(timeout=self.timeout * 2)
+        except TimeoutError as e:
+            raise FetchError(f'{url}: timed out waiting for the resize') from e
+        path = self.cache.get(digest, size)
+        if path is None:
+            raise FetchError(f'{url}: evicted before it was served')
+        return path, digest
+
+    def _finished(self, url, future):
+        with self._lock:
+            if self._pending.get(url) is future:
+                del self._pending[url]
+            error = future.exception()
+            if isinstance(error, FetchError):
+                if len(self._failures) > 10000:
+                    self._failures.clear()
+                self._failures[url] = (time.monotonic(), error)
+
+    def _build(self, url):
+        # IMAGE_ORIGIN is a host the operator chose, which may well be a private one
+        data = fetch(url, self.timeout, self.max_bytes, public_only=not self.origin)
+        digest = hashlib.sha256(data).hexdigest()
+        # the same picture under another link is already resized
+        renditions = {} if self.cache.has(digest, self.sizes) else render(data, self.sizes, self.quality)
+        self.cache.put(url, digest, renditions)
+        return digest
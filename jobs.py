@@ -0,0 +1,167 @@
+#----------------------------------------------------------------------------#
+# Background jobs.
+#----------------------------------------------------------------------------#
+
+# Request handlers enqueue follow-up work instead of doing it inline; a
+# `flask worker` process picks it up.  Two backends share one interface:
+#
+#   DatabaseQueue -- rows in the job_queue table, written in the same
+#                    transaction as the change that caused them and claimed
+#                    with SELECT ... FOR UPDATE SKIP LOCKED so any number of
+#                    workers can run side by side.
+#   MemoryQueue   -- a list guarded by a lock, for tests and local hacking.
+#
+# Handlers are registered with @job(name) and always receive a list of
+# payloads, so jobs of the same kind claimed together are handled as one
+# batch.  A dedup_key keeps at most one job per key waiting to be claimed.
+
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from model import QueuedJob
+
+JOB_HANDLERS = {}
+
+
+def job(name):
+    def register(handler):
+        JOB_HANDLERS[name] = handler
+        return handler
+    return register
+
+
+def _retry_delay(attempts):
+    # 2s, 4s, 8s, ... capped at ten minutes
+    return timedelta(seconds=min(2 ** attempts, 600))
+
+
+def _group_by_name(jobs):
+    groups = {}
+    for queued in jobs:
+        groups.setdefault(queued.name, []).append(queued)
+    return groups
+
+
+class MemoryQueue:
+
+    def __init__(self, max_attempts=5, session=None):
+        # Handlers write through session, committed per batch like DatabaseQueue
+        self.max_attempts = max_attempts
+        self.session = session
+        self.pending = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, name, payload, dedup_key=None):
+        with self._lock:
+            if dedup_key and any(queued.dedup_key == dedup_key for queued in self.pending):
+                return False
+            self.pending.append(QueuedJob(name=name, payload=json.dumps(payload), dedup_key=dedup_key,
+                                          attempts=0, run_at=datetime.utcnow()))
+            return True
+
+    def run_once(self, limit=100):
+        now = datetime.utcnow()
+        with self._lock:
+            claimed = [queued for queued in self.pending if queued.run_at <= now][:limit]
+            for queued in claimed:
+                self.pending.remove(queued)
+
+        for name, group in _group_by_name(claimed).items():
+            try:
+                JOB_HANDLERS[name]([json.loads(queued.payload) for queued in group])
+                if self.session is not None:
+                    self.session.commit()
+            except Exception as e:
+                if self.session is not None:
+                    self.session.rollback()
+                with self._lock:
+                    for queued in group:
+                        queued.attempts += 1
+                        queued.last_error = repr(e)
+                        queued.run_at = now + _retry_delay(queued.attempts)
+                        (self.failed if queued.attempts >= self.max_attempts else self.pending).append(queued)
+        return len(claimed)
+
+
+class DatabaseQueue:
+
+    def __init__(self, session, max_attempts=5):
+        self.session = session
+        self.max_attempts = max_attempts
+
+    def enqueue(self, name, payload, dedup_key=None):
+        # Joins the caller's transaction; nothing runs unless it commits.
+        # A pending row a worker has claimed (locked) may already be running
+        # with the old state, so only unclaimed ones absorb this job.
+        if dedup_key and self.session.query(QueuedJob.id) \
+                .filter_by(dedup_key=dedup_key, status='pending') \
+                .with_for_update(skip_locked=True).first():
+            return False
+        self.session.add(QueuedJob(name=name, payload=json.dumps(payload), dedup_key=dedup_key,
+                                   status='pending', attempts=0, run_at=datetime.utcnow()))
+        return True
+
+    def run_once(self, limit=100):
+        session = self.session
+        now = datetime.utcnow()
+        # Rows stay locked until the commit below, so a worker that dies
+        # mid-batch simply hands its jobs back to the queue.
+        claimed = session.query(QueuedJob) \
+            .filter(QueuedJob.status == 'pending', QueuedJob.run_at <= now) \
+            .order_by(QueuedJob.run_at, QueuedJob.id) \
+            .limit(limit) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+        for name, group in _group_by_name(claimed).items():
+            savepoint = session.begin_nested()
+            try:
+                JOB_HANDLERS[name]([json.loads(queued.payload) for queued in group])
+                savepoint.commit()
+            except Exception as e:
+                savepoint.rollback()
+                for queued in group:
+                    queued.attempts += 1
+                    queued.last_error = repr(e)
+                    queued.run_at = now + _retry_delay(queued.attempts)
+                    if queued.attempts >= self.max_attempts:
+                        queued.status = 'failed'
+            else:
+                for queued in group:
+                    session.delete(queued)
+        session.commit()
+        return len(claimed)
+
+
+def make_queue(backend, session, max_attempts=5):
+    if backend == 'memory':
+        return MemoryQueue(max_attempts=max_attempts, session=session)
+    return DatabaseQueue(session, max_attempts=max_attempts)
+
+
+def run_worker(queue, batch_size=100, poll_interval=1.0, once=False):
+    while True:
+        processed = queue.run_once(limit=batch_size)
+        if once:
+            return processed
+        if not processed:
+            time.sleep(poll_interval)
+
+
+#  Handlers
+#  ----------------------------------------------------------------
+
+# Callables taking the list of payloads of one catalog_changed batch
+CATALOG_LISTENERS = []
+
+
+@job('catalog_changed')
+def catalog_changed(payloads):
+    # Derived work for venue/artist/show writes hangs off this job, e.g.
+    # refreshing counts or purging cached pages.  Payloads look like
+    # {"entity": "venue", "id": 3, "action": "update"}.
+    for listener in CATALOG_LISTENERS:
+        listener(payloads)
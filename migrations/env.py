@@ -20,9 +20,11 @@ logger = logging.getLogger('alembic.env')
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
+# `flask db upgrade -x region=nyc` migrates one region shard (see SHARDS)
+region = context.get_x_argument(as_dictionary=True).get('region')
 config.set_main_option(
     'sqlalchemy.url',
-    str(current_app.extensions['migrate'].db.get_engine().url).replace(
+    str(current_app.extensions['migrate'].db.get_engine(bind=region).url).replace(
         '%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
@@ -71,7 +73,7 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
-    connectable = current_app.extensions['migrate'].db.get_engine()
+    connectable = current_app.extensions['migrate'].db.get_engine(bind=region)
 
     with connectable.connect() as connection:
         context.configure(
@@ -0,0 +1,34 @@
+"""add change_feed outbox table
+
+Revision ID: 5a8f3e9b2c61
+Revises: d27b6e0c5a13
+Create Date: 2026-10-19 15:02:47.118604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a8f3e9b2c61'
+down_revision = 'd27b6e0c5a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_feed',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('data', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index('ix_change_feed_created_at', 'change_feed', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_change_feed_created_at', table_name='change_feed')
+    op.drop_table('change_feed')
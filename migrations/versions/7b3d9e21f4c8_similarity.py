@@ -0,0 +1,31 @@
+"""add similarity table for recommendations
+
+Revision ID: 7b3d9e21f4c8
+Revises: e61c04b7d9a2
+Create Date: 2026-10-19 19:11:36.402187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3d9e21f4c8'
+down_revision = 'e61c04b7d9a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('similarity',
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.SmallInteger(), nullable=False),
+    sa.Column('similar_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'owner_id', 'rank')
+    )
+
+
+def downgrade():
+    op.drop_table('similarity')
@@ -0,0 +1,38 @@
+"""add job_queue table
+
+Revision ID: 8c1e5b4a9f27
+Revises: 3f9a2c71d0e4
+Create Date: 2026-10-19 10:41:05.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1e5b4a9f27'
+down_revision = '3f9a2c71d0e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job_queue',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('dedup_key', sa.String(length=200), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('run_at', sa.DateTime(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_job_queue_dedup_key', 'job_queue', ['dedup_key'], unique=False)
+    op.create_index('ix_job_queue_status_run_at', 'job_queue', ['status', 'run_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_job_queue_status_run_at', table_name='job_queue')
+    op.drop_index('ix_job_queue_dedup_key', table_name='job_queue')
+    op.drop_table('job_queue')
@@ -0,0 +1,42 @@
+"""version columns on Venue and Artist, idempotency_key table
+
+Revision ID: a4c7e2d90b35
+Revises: 7b3d9e21f4c8
+Create Date: 2026-10-19 21:03:18.526044
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e2d90b35'
+down_revision = '7b3d9e21f4c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('Venue', 'Artist'):
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        # archived rows keep every live column
+        op.add_column(f'{table}_archive', sa.Column('version', sa.Integer(), nullable=True))
+
+    op.create_table('idempotency_key',
+    sa.Column('endpoint', sa.String(length=80), nullable=False),
+    sa.Column('key', sa.String(length=200), nullable=False),
+    sa.Column('request_hash', sa.String(length=40), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('endpoint', 'key')
+    )
+    op.create_index('ix_idempotency_key_created_at', 'idempotency_key', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_key_created_at', table_name='idempotency_key')
+    op.drop_table('idempotency_key')
+    for table in ('Venue', 'Artist'):
+        op.drop_column(f'{table}_archive', 'version')
+        op.drop_column(table, 'version')
@@ -0,0 +1,28 @@
+"""add venue latitude/longitude
+
+Revision ID: d27b6e0c5a13
+Revises: 8c1e5b4a9f27
+Create Date: 2026-10-19 11:58:21.407736
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd27b6e0c5a13'
+down_revision = '8c1e5b4a9f27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Venue', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('Venue', sa.Column('longitude', sa.Float(), nullable=True))
+    op.create_index('ix_venue_latitude_longitude', 'Venue', ['latitude', 'longitude'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_venue_latitude_longitude', table_name='Venue')
+    op.drop_column('Venue', 'longitude')
+    op.drop_column('Venue', 'latitude')
@@ -0,0 +1,89 @@
+"""soft delete: deleted_at columns, partial indexes, archive tables
+
+Revision ID: e61c04b7d9a2
+Revises: 5a8f3e9b2c61
+Create Date: 2026-10-19 17:24:12.650391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e61c04b7d9a2'
+down_revision = '5a8f3e9b2c61'
+branch_labels = None
+depends_on = None
+
+LIVE = sa.text('deleted_at IS NULL')
+DELETED = sa.text('deleted_at IS NOT NULL')
+
+
+def upgrade():
+    for table in ('Venue', 'Artist', 'Show'):
+        op.add_column(table, sa.Column('deleted_at', sa.DateTime(), nullable=True))
+        op.create_index(f'ix_{table.lower()}_deleted_at', table, ['deleted_at'], unique=False,
+                        postgresql_where=DELETED, sqlite_where=DELETED)
+
+    # the booking indexes only need to cover live shows
+    for column in ('venue_id', 'artist_id'):
+        op.drop_index(f'ix_show_{column}_start_time', table_name='Show')
+        op.create_index(f'ix_show_{column}_start_time', 'Show', [column, 'start_time'], unique=False,
+                        postgresql_where=LIVE, sqlite_where=LIVE)
+
+    op.create_table('Venue_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('city', sa.String(length=120), nullable=True),
+    sa.Column('state', sa.String(length=120), nullable=True),
+    sa.Column('address', sa.String(length=120), nullable=True),
+    sa.Column('phone', sa.String(length=120), nullable=True),
+    sa.Column('image_link', sa.String(length=500), nullable=True),
+    sa.Column('facebook_link', sa.String(length=120), nullable=True),
+    sa.Column('website', sa.String(length=120), nullable=True),
+    sa.Column('seeking_talent', sa.Boolean(), nullable=True),
+    sa.Column('seeking_description', sa.String(length=120), nullable=True),
+    sa.Column('latitude', sa.Float(), nullable=True),
+    sa.Column('longitude', sa.Float(), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('Artist_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('city', sa.String(length=120), nullable=True),
+    sa.Column('state', sa.String(length=120), nullable=True),
+    sa.Column('phone', sa.String(length=120), nullable=True),
+    sa.Column('image_link', sa.String(length=500), nullable=True),
+    sa.Column('facebook_link', sa.String(length=120), nullable=True),
+    sa.Column('website', sa.String(length=120), nullable=True),
+    sa.Column('seeking_venue', sa.Boolean(), nullable=True),
+    sa.Column('seeking_description', sa.String(length=120), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('Show_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('start_time', sa.DateTime(), nullable=True),
+    sa.Column('artist_id', sa.Integer(), nullable=True),
+    sa.Column('venue_id', sa.Integer(), nullable=True),
+    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('Show_archive')
+    op.drop_table('Artist_archive')
+    op.drop_table('Venue_archive')
+
+    for column in ('venue_id', 'artist_id'):
+        op.drop_index(f'ix_show_{column}_start_time', table_name='Show')
+        op.create_index(f'ix_show_{column}_start_time', 'Show', [column, 'start_time'], unique=False)
+
+    for table in ('Venue', 'Artist', 'Show'):
+        op.drop_index(f'ix_{table.lower()}_deleted_at', table_name=table)
+        op.drop_column(table, 'deleted_at')
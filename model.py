@@ -2,22 +2,17 @@
 # Models.
 #----------------------------------------------------------------------------#
 import json
-import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, abort, jsonify
-from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
-import logging
-from logging import Formatter, FileHandler
-from forms import *
-from flask_migrate import Migrate
-
 from datetime import datetime
-import re
 
-app = Flask(__name__)
-moment = Moment(app)
-db = SQLAlchemy(app)
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm.exc import StaleDataError
+
+from shards import ShardedSQLAlchemy
+
+# The one SQLAlchemy instance; app.create_app() binds it to the app.  Its
+# session talks to the region shard of the current request, if any.
+db = ShardedSQLAlchemy()
+
 
 class Genre(db.Model):
     __tablename__ = 'Genre'
@@ -38,6 +33,13 @@ venue_genre_table = db.Table('venue_genre_table',
 
 class Venue(db.Model):
     __tablename__ = 'Venue'
+    # Bounding-box prefilter for "near me" searches, see geo.py
+    __table_args__ = (
+        db.Index('ix_venue_latitude_longitude', 'latitude', 'longitude'),
+        # only soft-deleted rows, for the purge
+        db.Index('ix_venue_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'), sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
@@ -54,13 +56,29 @@ class Venue(db.Model):
     seeking_talent = db.Column(db.Boolean, default=False)
     seeking_description = db.Column(db.String(120))
 
+    # Filled in offline from the gazetteer by `flask geocode-venues`
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+
+    # Set by softdelete.soft_delete(); such rows are invisible to queries
+    deleted_at = db.Column(db.DateTime)
+
+    # Edit count, see bump_version()
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
     
     shows = db.relationship('Show', backref='venue', lazy=True)    
 
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
+
 
 
 class Artist(db.Model):
     __tablename__ = 'Artist'
+    __table_args__ = (
+        db.Index('ix_artist_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'), sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
@@ -78,17 +96,180 @@ class Artist(db.Model):
     seeking_venue = db.Column(db.Boolean, default=False)
     seeking_description = db.Column(db.String(120))
 
+    deleted_at = db.Column(db.DateTime)
+
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
 
     shows = db.relationship('Show', backref='artist', lazy=True)  
 
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
+
 
 
 
 class Show(db.Model):
     __tablename__ = 'Show'
+    # Range lookups by venue/artist and start time back the booking conflict
+    # checks; they only cover live shows, deleted ones wait for the purge
+    __table_args__ = (
+        db.Index('ix_show_venue_id_start_time', 'venue_id', 'start_time',
+                 postgresql_where=db.text('deleted_at IS NULL'), sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_show_artist_id_start_time', 'artist_id', 'start_time',
+                 postgresql_where=db.text('deleted_at IS NULL'), sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_show_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL'), sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     start_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)    # Start time required field
 
     artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)   # Foreign key is the tablename.pk
-    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
\ No newline at end of file
+    venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
+    deleted_at = db.Column(db.DateTime)
+
+
+def _archive_table(model):
+    # Same columns as the live table, without constraints, plus archived_at
+    columns = [db.Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+               for column in model.__table__.columns]
+    return db.Table(f'{model.__tablename__}_archive', *columns,
+                    db.Column('archived_at', db.DateTime, nullable=False))
+
+
+# Soft-deleted rows end up here after the purge, see softdelete.py
+venue_archive = _archive_table(Venue)
+artist_archive = _archive_table(Artist)
+show_archive = _archive_table(Show)
+
+class QueuedJob(db.Model):
+    # Background work waiting for `flask worker`, see jobs.py
+    __tablename__ = 'job_queue'
+    __table_args__ = (
+        db.Index('ix_job_queue_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.Text, nullable=False)    # JSON
+    dedup_key = db.Column(db.String(200), index=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+
+
+class ChangeEvent(db.Model):
+    # Append-only outbox of catalog writes for downstream consumers, see changefeed.py
+    __tablename__ = 'change_feed'
+
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)    # venue, artist, show, genre, venue_genre, artist_genre
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)        # insert, update, delete
+    data = db.Column(db.Text)                            # JSON row, None for deletes
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class IdempotencyKey(db.Model):
+    # Responses of create requests by Idempotency-Key, replayed to retries, see idempotency.py
+    __tablename__ = 'idempotency_key'
+
+    endpoint = db.Column(db.String(80), primary_key=True)
+    key = db.Column(db.String(200), primary_key=True)
+    request_hash = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)          # JSON
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class Similarity(db.Model):
+    # Precomputed top-k similar artists/venues, rebuilt by `flask build-recommendations`, see recommend.py
+    __tablename__ = 'similarity'
+
+    kind = db.Column(db.String(10), primary_key=True)      # artist, venue
+    owner_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True)    # 0 is the most similar
+    similar_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def record_changes(session, changes):
+    """Append (entity, entity_id, op, data) tuples to the change feed.
+
+    The events are queued on the session and inserted by its commit (see
+    changefeed.py), in the same transaction as the writes they describe;
+    those recorded in a savepoint that rolls back are dropped with it.
+    """
+    if changes:
+        if isinstance(session, scoped_session):
+            session = session()
+        # lets caches drop what this transaction touched once it commits
+        session.info.setdefault('changed_entities', set()).update(change[0] for change in changes)
+        touch_rows(session, [(entity, entity_id, data) for entity, entity_id, op, data in changes])
+        session.info.setdefault('change_feed', []).extend(
+            (session.transaction, {'entity': entity, 'entity_id': entity_id, 'op': op,
+                                   'data': json.dumps(data, default=_json_default) if data is not None else None})
+            for entity, entity_id, op, data in changes)
+
+
+def touch_rows(session, rows):
+    # (entity, id, data) rows this transaction wrote, for in-process indexes
+    # to refresh once it commits (see facets.py); deletes may carry data too
+    session.info.setdefault('changed_rows', []).extend(rows)
+
+
+def sync_genres(session, owner, genre_names):
+    """Bring the genre association rows of an Artist or Venue in line with genre_names.
+
+    Only the set difference is written, as one bulk DELETE and one bulk INSERT,
+    and unknown genre names are ignored.  Returns (rows added, rows removed).
+    """
+    if isinstance(owner, Artist):
+        table, owner_column = artist_genre_table, artist_genre_table.c.artist_id
+    else:
+        table, owner_column = venue_genre_table, venue_genre_table.c.venue_id
+
+    wanted = {genre_id for genre_id, in session.query(Genre.id).filter(Genre.name.in_(set(genre_names)))} \
+        if genre_names else set()
+    current = {genre_id for genre_id, in session.query(table.c.genre_id).filter(owner_column == owner.id)}
+
+    to_remove = current - wanted
+    to_add = wanted - current
+    if to_remove:
+        session.execute(table.delete().where(owner_column == owner.id).where(table.c.genre_id.in_(to_remove)))
+    if to_add:
+        session.execute(table.insert(), [{owner_column.name: owner.id, 'genre_id': genre_id} for genre_id in to_add])
+    # bulk statements bypass the flush, so they go to the change feed here
+    link = 'artist_genre' if isinstance(owner, Artist) else 'venue_genre'
+    record_changes(session, [(link, owner.id, op, {owner_column.name: owner.id, 'genre_id': genre_id})
+                             for op, genre_ids in (('delete', to_remove), ('insert', to_add))
+                             for genre_id in sorted(genre_ids)])
+    if to_add or to_remove:
+        # the rows changed underneath the relationship, reload it on next access
+        session.expire(owner, ['genres'])
+    return len(to_add), len(to_remove)
+
+
+def bump_version(obj, expected=None):
+    """Count an edit of a Venue or Artist made from version `expected`.
+
+    Raises StaleDataError if obj has been edited since the form was rendered
+    with `expected`.  Edits racing this one are caught by the flush: the
+    UPDATE only matches the version this session loaded.
+    """
+    if expected is not None and obj.version != expected:
+        raise StaleDataError(f'{type(obj).__name__} {obj.id} is at version {obj.version}, not {expected}')
+    obj.version += 1
+
+
+def update_columns(obj, values):
+    # Assign only the columns that actually differ; returns the changed names
+    changed = [key for key, value in values.items() if getattr(obj, key) != value]
+    for key in changed:
+        setattr(obj, key, values[key])
+    return changed
@@ -0,0 +1,139 @@
+#----------------------------------------------------------------------------#
+# Request profiling.
+#----------------------------------------------------------------------------#
+
+# A fraction of requests (PROFILE_SAMPLE_RATE) is profiled by a stack
+# sampler: one background thread looks at the stacks of the threads serving
+# those requests every PROFILE_INTERVAL seconds and counts each distinct
+# stack per endpoint.  SQL, ORM hydration, template filters and Jinja all
+# show up as ordinary Python frames, so the counts say where the time goes.
+#
+# Per endpoint the profiler also keeps wall time and request counts.  Stacks
+# can be exported as collapsed stacks (flamegraph.pl, speedscope, ...) or
+# as a speedscope JSON file.
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class EndpointProfile:
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.stacks = Counter()     # root-first tuple of frame names -> samples
+
+
+class StackSampler:
+
+    def __init__(self, sample_rate, interval):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.profiles = defaultdict(EndpointProfile)
+        self._active = {}           # thread id -> endpoint
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, endpoint):
+        with self._lock:
+            self._active[threading.get_ident()] = endpoint
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+        return time.perf_counter()
+
+    def stop(self, endpoint, started):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+            profile = self.profiles[endpoint]
+            profile.requests += 1
+            profile.seconds += elapsed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, endpoint in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_name(frame))
+                        frame = frame.f_back
+                    self.profiles[endpoint].stacks[tuple(reversed(stack))] += 1
+
+    def top_endpoints(self):
+        # [(endpoint, profile)] sorted by cumulative wall time
+        with self._lock:
+            return sorted(self.profiles.items(), key=lambda item: item[1].seconds, reverse=True)
+
+    def collapsed(self, endpoint):
+        # One "frame;frame;frame count" line per stack
+        with self._lock:
+            stacks = list(self.profiles[endpoint].stacks.items()) if endpoint in self.profiles else []
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(stacks))
+
+    def speedscope(self, endpoint):
+        with self._lock:
+            stacks = list(self.profiles[endpoint].stacks.items()) if endpoint in self.profiles else []
+        frames, index, samples, weights = [], {}, [], []
+        for stack, count in stacks:
+            sample = []
+            for name in stack:
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({'name': name})
+                sample.append(index[name])
+            samples.append(sample)
+            weights.append(count * self.interval * 1000)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': endpoint,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights
+            }],
+            'name': f'fyyur {endpoint}',
+            'exporter': 'fyyur profiling'
+        }
+
+    def dump(self, directory):
+        """Write <endpoint>.collapsed and <endpoint>.speedscope.json files; returns their paths."""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for endpoint, _ in self.top_endpoints():
+            collapsed = os.path.join(directory, f'{endpoint}.collapsed')
+            with open(collapsed, 'w') as f:
+                f.write(self.collapsed(endpoint))
+            speedscope = os.path.join(directory, f'{endpoint}.speedscope.json')
+            with open(speedscope, 'w') as f:
+                json.dump(self.speedscope(endpoint), f)
+            paths += [collapsed, speedscope]
+        return paths
+
+    def reset(self):
+        with self._lock:
+            self.profiles.clear()
@@ -0,0 +1,143 @@
+#----------------------------------------------------------------------------#
+# Rate limiting and load shedding.
+#----------------------------------------------------------------------------#
+
+# RateLimiter  -- token bucket per (client, endpoint).  Buckets live in a
+#                 BucketStore; MemoryBucketStore is per process, a shared
+#                 store (Redis, memcached, ...) only has to implement take().
+# Admission    -- sheds load with 503 + Retry-After once too many requests
+#                 are in flight or connections take too long to come out of
+#                 the pool, so a busy database slows nobody down further.
+
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from sqlalchemy.pool import QueuePool
+
+
+class BucketStore(ABC):
+    # Interface for bucket storage shared between processes
+
+    @abstractmethod
+    def take(self, key, rate, burst, now):
+        """Take one token from bucket key, refilled at rate tokens/s up to burst.
+
+        Returns 0 if a token was taken, else the seconds until one is available.
+        """
+
+
+class MemoryBucketStore(BucketStore):
+    # A bucket that has refilled to its burst is the same as no bucket, so
+    # those are dropped as they age out; past max_buckets the least recently
+    # used go regardless, which at worst hands an idle client a fresh burst.
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()   # key -> (tokens, updated at, full again at), least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated, _ = self._buckets.pop(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            self._expire(now)
+            return wait
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, (_, _, full_at) = next(iter(buckets.items()))
+            if full_at > now and len(buckets) <= self.max_buckets:
+                break
+            del buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimiter:
+
+    def __init__(self, store, limits):
+        # limits: {endpoint: (tokens per second, burst)}
+        self.store = store
+        self.limits = limits
+
+    def check(self, client, endpoint):
+        # Seconds the client has to wait, 0 if the request may go ahead
+        if endpoint not in self.limits:
+            return 0
+        rate, burst = self.limits[endpoint]
+        return self.store.take(f'{client}:{endpoint}', rate, burst, time.monotonic())
+
+
+class PoolWait:
+    # Moving average of how long connection checkouts take.  It decays with
+    # time as well, so shedding every request cannot pin it high forever.
+
+    def __init__(self, weight=0.2, half_life=5.0):
+        self.weight = weight
+        self.half_life = half_life
+        self._average = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _decayed(self, now):
+        return self._average * 0.5 ** ((now - self._updated) / self.half_life)
+
+    @property
+    def average(self):
+        return self._decayed(time.monotonic())
+
+    def record(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            average = self._decayed(now)
+            self._average = average + self.weight * (seconds - average)
+            self._updated = now
+
+
+pool_wait = PoolWait()
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that reports checkout wait times to pool_wait
+
+    def connect(self):
+        started = time.monotonic()
+        try:
+            return super().connect()
+        finally:
+            pool_wait.record(time.monotonic() - started)
+
+
+class Admission:
+
+    def __init__(self, max_in_flight, max_pool_wait, retry_after):
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        # True if the request is admitted; admitted requests must call leave()
+        with self._lock:
+            if self.in_flight >= self.max_in_flight or pool_wait.average > self.max_pool_wait:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
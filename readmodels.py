@@ -0,0 +1,55 @@
+#----------------------------------------------------------------------------#
+# Read models.
+#----------------------------------------------------------------------------#
+
+# List pages and searches only read a few columns.  Loading them as full
+# ORM instances means identity-map bookkeeping, change tracking and one
+# object per related row.  The row types below are plain namedtuples built
+# from column-only queries.  They expose the same attribute names the
+# templates already use (show.artist.name, venue.num_upcoming_shows, ...),
+# so the templates don't change.
+#
+# benchmarks/read_models.py compares both approaches.
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, func
+
+from model import Venue, Artist, Show
+
+ArtistRef = namedtuple('ArtistRef', 'id name image_link')
+VenueRef = namedtuple('VenueRef', 'id name image_link')
+ShowTile = namedtuple('ShowTile', 'id start_time artist venue')
+SearchResult = namedtuple('SearchResult', 'id name num_upcoming_shows')
+
+
+def show_tiles(session, batch_size=None):
+    # Every show with its artist and venue, ordered by start time
+    query = session.query(Show.id, Show.start_time,
+                          Artist.id, Artist.name, Artist.image_link,
+                          Venue.id, Venue.name, Venue.image_link) \
+        .join(Artist, Show.artist_id == Artist.id) \
+        .join(Venue, Show.venue_id == Venue.id) \
+        .order_by(Show.start_time, Show.id)
+    if batch_size:
+        query = query.yield_per(batch_size)
+    for show_id, start_time, artist_id, artist_name, artist_image, venue_id, venue_name, venue_image in query:
+        yield ShowTile(show_id, start_time,
+                       ArtistRef(artist_id, artist_name, artist_image),
+                       VenueRef(venue_id, venue_name, venue_image))
+
+
+def search(session, model, term):
+    """Case-insensitive substring search on name, with upcoming show counts.
+
+    Returns a list of SearchResult; the counts come from the same query.
+    """
+    owner = Show.venue_id if model is Venue else Show.artist_id
+    num_upcoming = func.count(Show.id)
+    query = session.query(model.id, model.name, num_upcoming) \
+        .outerjoin(Show, and_(owner == model.id, Show.start_time > datetime.now())) \
+        .filter(model.name.ilike(f'%{term}%')) \
+        .group_by(model.id, model.name) \
+        .order_by(model.name, model.id)
+    return [SearchResult(*row) for row in query]
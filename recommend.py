@@ -0,0 +1,185 @@
+#----------------------------------------------------------------------------#
+# Similar artists and venues.
+#----------------------------------------------------------------------------#
+
+# `flask build-recommendations` precomputes, for every artist and venue, its
+# top-k most similar artists/venues into the similarity table, and the detail
+# pages read them back with one primary-key range scan (similar()).
+#
+# Similarity of two artists mixes
+#   genre Jaccard   |genres(a) & genres(b)| / |genres(a) | genres(b)|
+#   co-booking      cosine of their 0/1 rows in the artist x venue matrix
+#                   (shared venues / sqrt(venues(a) * venues(b)))
+# as RECOMMEND_GENRE_WEIGHT * jaccard + (1 - weight) * cosine; venues are
+# scored the same way from their genres and the artists they booked.
+#
+# Candidate pairs come from the sparse product M @ M.T of the incidence
+# matrix, computed a block of rows at a time so memory stays bounded, and
+# Jaccard is only evaluated on those pairs, with genre sets packed into
+# uint64 bit masks.  Entities without enough co-booked neighbours are topped
+# up with the most booked members of the same genre set.
+#
+# NumPy and SciPy are only needed to build the table; they are imported in
+# the build functions so the web app doesn't load them.
+
+from itertools import chain, islice
+
+from sqlalchemy import and_, select
+
+from model import Venue, Artist, Show, Similarity, artist_genre_table, venue_genre_table
+from readmodels import ArtistRef, VenueRef
+
+
+def similar(session, kind, id, limit=6):
+    """Precomputed neighbours of an artist or venue, best first."""
+    model, ref = (Artist, ArtistRef) if kind == 'artist' else (Venue, VenueRef)
+    rows = session.query(model.id, model.name, model.image_link) \
+        .join(Similarity, and_(Similarity.similar_id == model.id,
+                               Similarity.kind == kind, Similarity.owner_id == id)) \
+        .order_by(Similarity.rank) \
+        .limit(limit)
+    return [ref(*row) for row in rows]
+
+
+def _pairs(session, query):
+    # (n, 2) int array from a two-column Core select; these run to hundreds of
+    # thousands of rows, where ORM tuples and np.array(rows) are several times slower
+    import numpy as np
+    rows = session.execute(query).fetchall()
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)).reshape(-1, 2)
+
+
+def _load(session, kind):
+    import numpy as np
+    from scipy import sparse
+
+    if kind == 'artist':
+        model, link, owner, context = Artist, artist_genre_table, artist_genre_table.c.artist_id, Show.venue_id
+        show_owner = Show.artist_id
+    else:
+        model, link, owner, context = Venue, venue_genre_table, venue_genre_table.c.venue_id, Show.artist_id
+        show_owner = Show.venue_id
+
+    ids = np.array([id for id, in session.query(model.id).order_by(model.id)], dtype=np.int64)
+    n = len(ids)
+
+    def positions(values):
+        # index into ids, -1 for ids that aren't live
+        values = np.asarray(values, dtype=np.int64)
+        found = np.searchsorted(ids, values)
+        found[found >= n] = 0
+        return np.where((n > 0) & (ids[found] == values), found, -1) if n else np.full(len(values), -1)
+
+    # positions() drops rows of deleted owners
+    links = _pairs(session, select([owner, link.c.genre_id]))
+    rows = positions(links[:, 0])
+    links, rows = links[rows >= 0], rows[rows >= 0]
+    words = int(links[:, 1].max()) // 64 + 1 if len(links) else 1
+    masks = np.zeros((n, words), dtype=np.uint64)
+    np.bitwise_or.at(masks, (rows, links[:, 1] // 64),
+                     np.left_shift(np.uint64(1), (links[:, 1] % 64).astype(np.uint64)))
+
+    shows = _pairs(session, select([show_owner, context]).where(Show.deleted_at.is_(None)))
+    rows = positions(shows[:, 0])
+    shows, rows = shows[rows >= 0], rows[rows >= 0]
+    contexts, columns = np.unique(shows[:, 1], return_inverse=True)
+    popularity = np.bincount(rows, minlength=n)
+    incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns.ravel())),
+                                  shape=(n, len(contexts)))
+    incidence.data[:] = 1   # duplicates were summed; only "booked there at all" counts
+    return ids, masks, incidence, popularity
+
+
+_POPCOUNT = None
+
+
+def _jaccard(masks, rows, cols):
+    import numpy as np
+    global _POPCOUNT
+    if _POPCOUNT is None:
+        _POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+    a, b = masks[rows], masks[cols]
+    inter = _POPCOUNT[(a & b).view(np.uint8)].sum(axis=1, dtype=np.int32)
+    union = _POPCOUNT[(a | b).view(np.uint8)].sum(axis=1, dtype=np.int32)
+    return np.divide(inter, union, out=np.zeros(len(rows), dtype=np.float32), where=union > 0)
+
+
+def _genre_candidates(masks, popularity, k):
+    # (rows, cols) pairing everyone with the k + 1 most booked entities of the
+    # same genre set, sorted by row
+    import numpy as np
+    n = len(masks)
+    _, group = np.unique(masks, axis=0, return_inverse=True)
+    group = group.ravel()
+    order = np.lexsort((-popularity, group))
+    sorted_groups = group[order]
+    rank = np.arange(n) - np.searchsorted(sorted_groups, sorted_groups)
+    top, top_groups = order[rank <= k], sorted_groups[rank <= k]
+
+    lo = np.searchsorted(top_groups, group)
+    counts = np.searchsorted(top_groups, group, side='right') - lo
+    counts[~masks.any(axis=1)] = 0     # no genres, nothing in common
+    rows = np.repeat(np.arange(n), counts)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = top[np.repeat(lo, counts) + offsets]
+    keep = rows != cols
+    return rows[keep], cols[keep]
+
+
+def neighbours(masks, incidence, popularity, k=10, genre_weight=0.4, block_size=2000):
+    """Top-k neighbour positions and scores per row, -1 / 0 where there are fewer."""
+    import numpy as np
+
+    n = incidence.shape[0]
+    degree = np.asarray(incidence.sum(axis=1), dtype=np.float32).ravel()
+    transposed = incidence.T.tocsr()
+    genre_rows, genre_cols = _genre_candidates(masks, popularity, k)
+
+    best = np.full((n, k), -1, dtype=np.int64)
+    scores = np.zeros((n, k), dtype=np.float32)
+    for start in range(0, n, block_size):
+        stop = min(n, start + block_size)
+        shared = (incidence[start:stop] @ transposed).tocoo()
+        rows = shared.row.astype(np.int64) + start
+        cols = shared.col.astype(np.int64)
+        cosine = shared.data / np.sqrt(degree[rows] * degree[cols])
+
+        lo, hi = np.searchsorted(genre_rows, [start, stop])
+        rows = np.concatenate([rows, genre_rows[lo:hi]])
+        cols = np.concatenate([cols, genre_cols[lo:hi]])
+        cosine = np.concatenate([cosine, np.zeros(hi - lo, dtype=np.float32)])
+        keep = rows != cols
+        rows, cols, cosine = rows[keep], cols[keep], cosine[keep]
+        score = genre_weight * _jaccard(masks, rows, cols) + (1 - genre_weight) * cosine
+
+        # best score per (row, col), then the k best per row, ties to the more booked
+        order = np.lexsort((-score, cols, rows))
+        rows, cols, score = rows[order], cols[order], score[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, score = rows[first], cols[first], score[first]
+        order = np.lexsort((-popularity[cols], -score, rows))
+        rows, cols, score = rows[order], cols[order], score[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        top = rank < k
+        best[rows[top], rank[top]] = cols[top]
+        scores[rows[top], rank[top]] = score[top]
+    return best, scores
+
+
+def build(session, kind, k=10, genre_weight=0.4, block_size=2000):
+    """Recompute the similarity rows of one kind; returns how many were written."""
+    import numpy as np
+    ids, masks, incidence, popularity = _load(session, kind)
+    best, scores = neighbours(masks, incidence, popularity, k, genre_weight, block_size)
+
+    session.query(Similarity).filter(Similarity.kind == kind).delete(synchronize_session=False)
+    # ranks are filled left to right, so the valid slots of a row are a prefix
+    owners, ranks = np.nonzero((best >= 0) & (scores > 0))
+    rows = zip(ids[owners].tolist(), ranks.tolist(), ids[best[owners, ranks]].tolist(),
+               scores[owners, ranks].tolist())
+    for _ in range(0, len(owners), 10000):
+        session.execute(Similarity.__table__.insert(), [
+            {'kind': kind, 'owner_id': owner, 'rank': rank, 'similar_id': similar_id, 'score': score}
+            for owner, rank, similar_id, score in islice(rows, 10000)])
+    return len(owners)
@@ -0,0 +1,151 @@
+#----------------------------------------------------------------------------#
+# Show scheduling.
+#----------------------------------------------------------------------------#
+
+# Books one or many shows in a single transaction.  Instead of looking up
+# every row on its own, all referenced artists/venues are checked with one
+# IN query each, and double-bookings are found with one indexed start_time
+# range query per side (see the Show indexes in model.py).  Bookings already
+# in the database and earlier rows of the same batch are kept in sorted lists
+# per venue/artist so each row is checked with a bisect.
+
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from model import Venue, Artist, Show, record_changes
+
+# ISO 8601 date and time, e.g. 2026-05-21T21:30 or 2026-05-21 21:30:00
+_START_TIME = re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}')
+
+
+class ScheduleError(Exception):
+    # errors is a list of {"row": index, "errors": [messages]}, one per bad row
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} show(s) could not be scheduled')
+        self.errors = errors
+
+
+def parse_show_row(row):
+    # Accepts the stripped strings ShowForm hands over as well as JSON values
+    errors = []
+    parsed = {}
+    for key in ('artist_id', 'venue_id'):
+        try:
+            parsed[key] = int(str(row.get(key, '')).strip())
+        except ValueError:
+            errors.append(f'{key} must be an integer')
+    start_time = row.get('start_time')
+    if isinstance(start_time, datetime):
+        parsed['start_time'] = start_time
+    else:
+        # strict: a fuzzy parser would take "12" for noon today
+        try:
+            if not _START_TIME.match(str(start_time)):
+                raise ValueError(start_time)
+            parsed['start_time'] = datetime.fromisoformat(str(start_time))
+        except ValueError:
+            errors.append('start_time must be an ISO 8601 date and time, e.g. 2026-05-21T21:30')
+    # start times are stored as the venue's local wall-clock time; an offset
+    # can't be mapped onto that, and aware datetimes don't compare with naive ones
+    if parsed.get('start_time') is not None and parsed['start_time'].utcoffset() is not None:
+        del parsed['start_time']
+        errors.append('start_time must be a local time without a UTC offset')
+    return parsed, errors
+
+
+def _booked_times(session, column, ids, earliest, latest):
+    booked = defaultdict(list)
+    if not ids:
+        return booked
+    rows = session.query(column, Show.start_time) \
+        .filter(column.in_(ids), Show.start_time > earliest, Show.start_time < latest) \
+        .order_by(column, Show.start_time)
+    for owner_id, start_time in rows:
+        booked[owner_id].append(start_time)
+    return booked
+
+
+def _is_booked(times, start_time, slot):
+    # times is sorted; only the neighbours of start_time can overlap it
+    i = bisect_left(times, start_time)
+    if i < len(times) and times[i] - start_time < slot:
+        return True
+    return i > 0 and start_time - times[i - 1] < slot
+
+
+def check_shows(session, rows, slot):
+    """Return (parsed rows, per-row errors) for a batch of show dicts."""
+    parsed_rows = []
+    errors = []
+    for index, row in enumerate(rows):
+        parsed, row_errors = parse_show_row(row)
+        parsed_rows.append(parsed)
+        if row_errors:
+            errors.append({"row": index, "errors": row_errors})
+
+    valid = [row for row in parsed_rows if len(row) == 3]
+    if not valid:
+        return parsed_rows, errors
+
+    artist_ids = {row['artist_id'] for row in valid}
+    venue_ids = {row['venue_id'] for row in valid}
+    # FOR UPDATE serialises concurrent bookings of the same artist/venue
+    known_artists = {artist_id for artist_id, in session.query(Artist.id)
+                     .filter(Artist.id.in_(artist_ids)).with_for_update()}
+    known_venues = {venue_id for venue_id, in session.query(Venue.id)
+                    .filter(Venue.id.in_(venue_ids)).with_for_update()}
+
+    earliest = min(row['start_time'] for row in valid) - slot
+    latest = max(row['start_time'] for row in valid) + slot
+    artist_times = _booked_times(session, Show.artist_id, known_artists, earliest, latest)
+    venue_times = _booked_times(session, Show.venue_id, known_venues, earliest, latest)
+
+    bad_rows = {error['row'] for error in errors}
+    for index, row in enumerate(parsed_rows):
+        if index in bad_rows:
+            continue
+        row_errors = []
+        artist_id, venue_id, start_time = row['artist_id'], row['venue_id'], row['start_time']
+        if artist_id not in known_artists:
+            row_errors.append(f'artist {artist_id} does not exist')
+        elif _is_booked(artist_times[artist_id], start_time, slot):
+            row_errors.append(f'artist {artist_id} is already booked around {start_time}')
+        if venue_id not in known_venues:
+            row_errors.append(f'venue {venue_id} does not exist')
+        elif _is_booked(venue_times[venue_id], start_time, slot):
+            row_errors.append(f'venue {venue_id} is already booked around {start_time}')
+
+        if row_errors:
+            errors.append({"row": index, "errors": row_errors})
+        else:
+            # later rows of the same batch must not collide with this one
+            insort(artist_times[artist_id], start_time)
+            insort(venue_times[venue_id], start_time)
+
+    errors.sort(key=lambda error: error['row'])
+    return parsed_rows, errors
+
+
+def schedule_shows(session, rows, slot_hours):
+    """Insert all rows or none of them; raises ScheduleError with a per-row report.
+
+    Returns the inserted rows as dicts of id, artist_id, venue_id and start_time.
+    """
+    slot = timedelta(hours=slot_hours)
+    parsed_rows, errors = check_shows(session, rows, slot)
+    if errors:
+        raise ScheduleError(errors)
+    if parsed_rows:
+        session.execute(Show.__table__.insert(), parsed_rows)
+        # executemany returns no keys; an artist can't have two shows at the
+        # same time, so (artist_id, start_time) finds the new rows again
+        ids = {(artist_id, start_time): id for id, artist_id, start_time in
+               session.query(Show.id, Show.artist_id, Show.start_time)
+               .filter(Show.artist_id.in_({row['artist_id'] for row in parsed_rows}))
+               .filter(Show.start_time.in_({row['start_time'] for row in parsed_rows}))}
+        for row in parsed_rows:
+            row['id'] = ids[row['artist_id'], row['start_time']]
+        record_changes(session, [('show', row['id'], 'insert', row) for row in parsed_rows])
+    return parsed_rows
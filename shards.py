@@ -0,0 +1,108 @@
+#----------------------------------------------------------------------------#
+# Region shards.
+#----------------------------------------------------------------------------#
+
+# Each market (region) can keep its whole catalog in its own database.
+# SHARDS maps region -> database URI; they become Flask-SQLAlchemy binds.
+# ShardedSQLAlchemy's session sends every statement to the engine of the
+# region stored in g.shard, or to SQLALCHEMY_DATABASE_URI when none is set,
+# so the models and queries don't need to know about regions.
+#
+# ShardRouter picks the region for a request: an explicit ?region= or
+# X-Fyyur-Region wins, then SHARD_HOSTS (host name -> region), then
+# DEFAULT_SHARD.  fan_out() runs a function against every shard in
+# parallel, each in its own app context and session, for admin queries;
+# in_background() runs one against the current shard without waiting, for
+# cache rebuilds.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+
+class UnknownShard(Exception):
+    pass
+
+
+def current_shard():
+    return g.get('shard') if has_app_context() else None
+
+
+class ShardSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = current_shard()
+        if shard is not None:
+            return get_state(self.app).db.get_engine(self.app, bind=shard)
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+
+    def init_app(self, app):
+        shards = app.config.get('SHARDS') or {}
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **shards)
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardSession, db=self, **options)
+
+
+class ShardRouter:
+
+    def __init__(self, shards, hosts, default=None):
+        self.shards = set(shards)
+        self.hosts = hosts
+        self.default = default
+
+    def resolve(self, request):
+        """Region for the request, or None when sharding is off."""
+        if not self.shards:
+            return None
+        region = request.args.get('region') or request.headers.get('X-Fyyur-Region')
+        if region is None:
+            region = self.hosts.get(request.host.split(':')[0], self.default)
+        if region not in self.shards:
+            raise UnknownShard(region)
+        return region
+
+
+def fan_out(db, fn, regions=None):
+    """Call fn(session) once per shard in parallel; returns {region: result}.
+
+    Without SHARDS there is a single region, None.
+    """
+    app = current_app._get_current_object()
+    regions = list(regions or app.config.get('SHARDS') or [None])
+
+    def run(region):
+        with app.app_context():
+            g.shard = region
+            try:
+                return fn(db.session)
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+        return dict(zip(regions, pool.map(run, regions)))
+
+
+def in_background(db, fn, name):
+    """Start fn(session) in a daemon thread, on the current app and shard."""
+    app = current_app._get_current_object()
+    region = current_shard()
+
+    def run():
+        with app.app_context():
+            g.shard = region
+            try:
+                fn(db.session)
+            except Exception:
+                app.logger.exception(f'{name} failed')
+            finally:
+                db.session.remove()
+
+    threading.Thread(target=run, name=name, daemon=True).start()
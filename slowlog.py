@@ -0,0 +1,182 @@
+#----------------------------------------------------------------------------#
+# Slow query log.
+#----------------------------------------------------------------------------#
+
+# Every statement run through SQLAlchemy is timed.  Statements slower than
+# SLOW_QUERY_THRESHOLD seconds are written as JSON lines to a rotating file
+# together with their parameters and the Flask endpoint that issued them.
+# The first time a statement shape (fingerprint: literals and parameters
+# stripped) turns up, its plan is captured with EXPLAIN on a separate cursor,
+# without ANALYZE, so the statement is not run twice.  Only queries and DML
+# are explained, and on Postgres inside a savepoint, so a failing EXPLAIN
+# can't abort the transaction of the request that ran the statement.
+#
+# `flask slow-queries` summarises the log per fingerprint and flags plans
+# containing sequential scans or large row estimates.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+_ROWS = re.compile(r'rows=(\d+)')
+
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN (ANALYZE off) ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+# Statements EXPLAIN accepts; SAVEPOINT, SET, DDL and the like are skipped
+_EXPLAINABLE = re.compile(r'\s*\(*\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.I)
+# Dialects where any error aborts the surrounding transaction
+_ABORTS_TRANSACTION = {'postgresql'}
+
+
+def fingerprint(statement):
+    normalized = statement.strip()
+    for pattern, replacement in _LITERALS:
+        normalized = pattern.sub(replacement, normalized)
+    return hashlib.md5(normalized.encode()).hexdigest()[:12], normalized
+
+
+class SlowQueryLog:
+
+    _installed = None   # one per process; installing another replaces it
+
+    def __init__(self, threshold, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.threshold = threshold
+        self.explained = set()
+        self.logger = logging.getLogger('fyyur.slow_queries')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def install(self):
+        # Listens on every Engine, so it also covers engines created later
+        if SlowQueryLog._installed is not None:
+            SlowQueryLog._installed.uninstall()
+        SlowQueryLog._installed = self
+        self.logger.addHandler(self.handler)
+        event.listen(Engine, 'before_cursor_execute', self._before)
+        event.listen(Engine, 'after_cursor_execute', self._after)
+        event.listen(Engine, 'handle_error', self._failed)
+
+    def uninstall(self):
+        event.remove(Engine, 'before_cursor_execute', self._before)
+        event.remove(Engine, 'after_cursor_execute', self._after)
+        event.remove(Engine, 'handle_error', self._failed)
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        if SlowQueryLog._installed is self:
+            SlowQueryLog._installed = None
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _failed(self, context):
+        # after_cursor_execute doesn't run for a statement that raised
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        if elapsed < self.threshold:
+            return
+
+        key, normalized = fingerprint(statement)
+        record = {
+            'time': datetime.utcnow().isoformat(),
+            'fingerprint': key,
+            'duration_ms': round(elapsed * 1000, 2),
+            'statement': statement,
+            'normalized': normalized,
+            'parameters': parameters,
+            'route': request.endpoint if has_request_context() else None,
+        }
+        if key not in self.explained and not executemany:
+            self.explained.add(key)
+            record['plan'] = self._explain(conn, statement, parameters)
+        self.logger.info(json.dumps(record, default=str))
+
+    def _explain(self, conn, statement, parameters):
+        prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+        if prefix is None or not _EXPLAINABLE.match(statement):
+            return None
+        dbapi_connection = conn.connection.connection
+        savepoint = conn.dialect.name in _ABORTS_TRANSACTION and not getattr(dbapi_connection, 'autocommit', False)
+        # a fresh DBAPI cursor leaves the caller's result set alone
+        cursor = dbapi_connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = '\n'.join(' | '.join(str(value) for value in row) for row in cursor.fetchall())
+            except Exception as e:
+                if savepoint:
+                    cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                plan = f'EXPLAIN failed: {e}'
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        except Exception as e:
+            return f'EXPLAIN failed: {e}'
+        finally:
+            cursor.close()
+
+
+def _records(path):
+    # Oldest rotated file first
+    paths = [f'{path}.{n}' for n in range(20, 0, -1)] + [path]
+    for candidate in paths:
+        if os.path.exists(candidate):
+            with open(candidate) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def report(path, row_estimate_limit=10000):
+    """Summarise the slow query log per fingerprint, slowest total first."""
+    summary = {}
+    for record in _records(path):
+        entry = summary.setdefault(record['fingerprint'], {
+            'fingerprint': record['fingerprint'],
+            'statement': record['normalized'],
+            'count': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'routes': set(),
+            'plan': None,
+        })
+        entry['count'] += 1
+        entry['total_ms'] += record['duration_ms']
+        entry['max_ms'] = max(entry['max_ms'], record['duration_ms'])
+        if record.get('route'):
+            entry['routes'].add(record['route'])
+        if record.get('plan'):
+            entry['plan'] = record['plan']
+
+    for entry in summary.values():
+        plan = entry['plan'] or ''
+        # Postgres says "Seq Scan on ...", SQLite "SCAN <table>" without USING INDEX
+        entry['seq_scan'] = 'Seq Scan' in plan or re.search(r'\bSCAN [\w"]+\s*$', plan, re.M) is not None
+        entry['max_rows'] = max((int(rows) for rows in _ROWS.findall(plan)), default=None)
+        entry['high_rows'] = entry['max_rows'] is not None and entry['max_rows'] > row_estimate_limit
+    return sorted(summary.values(), key=lambda entry: entry['total_ms'], reverse=True)
@@ -0,0 +1,134 @@
+#----------------------------------------------------------------------------#
+# Soft delete.
+#----------------------------------------------------------------------------#
+
+# Deleting a venue or artist only stamps deleted_at on it and on its live
+# shows, one indexed UPDATE, so the request never waits on dependent rows.
+# Every ORM query leaves rows with deleted_at set out (a before_compile hook
+# adds the filter for each Venue, Artist or Show entity it selects); pass
+# .execution_options(include_deleted=True) to see them anyway.  An entity on
+# the optional side of an outer join gets the filter in the join's ON clause
+# instead: in WHERE it would drop the rows the join found nothing for, e.g.
+# a venue whose shows were all deleted from a count of its shows.
+#
+# purge() later moves deleted rows to the *_archive tables in batches,
+# shows first so foreign keys hold, which keeps the live tables and their
+# partial indexes small.  The worker runs it after deletes, and
+# `flask purge-deleted` drains any backlog.
+
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, event, literal, or_, select
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import visitors
+
+from model import Venue, Artist, Show, artist_genre_table, venue_genre_table, \
+    venue_archive, artist_archive, show_archive, record_changes, touch_rows
+
+SOFT_DELETED = (Venue, Artist, Show)
+_ARCHIVES = {Venue: venue_archive, Artist: artist_archive, Show: show_archive}
+_BY_TABLE = {entity.__table__: entity for entity in SOFT_DELETED}
+
+
+def _outer_joined(query):
+    # soft-deleted entities joined by query.outerjoin() as the optional side
+    found = set()
+    for from_obj in query._from_obj:
+        for join in visitors.iterate(from_obj, {}):
+            if getattr(join, 'isouter', False) and join.right in _BY_TABLE:
+                found.add(_BY_TABLE[join.right])
+    return found
+
+
+def _filter_join(join):
+    if join.isouter and join.right in _BY_TABLE:
+        join.onclause = and_(join.onclause, _BY_TABLE[join.right].deleted_at.is_(None))
+
+
+def _exclude_deleted(query):
+    if query._execution_options.get('include_deleted'):
+        return query
+    outer = _outer_joined(query)
+    if outer:
+        query = query._clone()
+        query._from_obj = tuple(visitors.cloned_traverse(from_obj, {}, {'join': _filter_join})
+                                for from_obj in query._from_obj)
+    # several columns of one entity (Show.venue_id, count(Show.id)) need one filter
+    entities = {description['entity'] for description in query.column_descriptions}
+    for entity in SOFT_DELETED:
+        if entity in entities and entity not in outer:
+            query = query.enable_assertions(False).filter(entity.deleted_at.is_(None))
+    return query
+
+
+def listen():
+    # The filter doesn't depend on parameters, so baked (lazy load) queries may cache it
+    event.listen(Query, 'before_compile', _exclude_deleted, retval=True, bake_ok=True)
+
+
+def soft_delete(session, obj, now=None):
+    """Mark a Venue or Artist and its live shows deleted; returns the number of shows."""
+    now = now or datetime.utcnow()
+    obj.deleted_at = now
+    owner = Show.venue_id if isinstance(obj, Venue) else Show.artist_id
+    shows = session.query(Show.id, Show.artist_id, Show.venue_id).filter(owner == obj.id).all()
+    show_ids = [id for id, _, _ in shows]
+    if show_ids:
+        session.query(Show).filter(Show.id.in_(show_ids)) \
+            .update({Show.deleted_at: now}, synchronize_session=False)
+        record_changes(session, [('show', id, 'delete', None) for id in show_ids])
+        # the other side of each show may have lost its upcoming shows
+        touch_rows(session, [('show', id, {'artist_id': artist_id, 'venue_id': venue_id})
+                             for id, artist_id, venue_id in shows])
+    return len(show_ids)
+
+
+def _deleted_ids(session, model, older_than, limit):
+    return [id for id, in session.query(model.id)
+            .execution_options(include_deleted=True)
+            .filter(model.deleted_at < older_than)
+            .order_by(model.deleted_at)
+            .limit(limit)]
+
+
+def _archive(session, model, ids, now):
+    table, archive = model.__table__, _ARCHIVES[model]
+    names = [column.name for column in table.columns]
+    rows = select([table.c[name] for name in names] + [literal(now, DateTime)]).where(table.c.id.in_(ids))
+    session.execute(archive.insert().from_select(names + ['archived_at'], rows))
+    session.execute(table.delete().where(table.c.id.in_(ids)))
+
+
+def purge(session, older_than, batch_size=500):
+    """Move one batch of rows deleted before older_than to the archive tables.
+
+    Returns {"venue": n, "artist": n, "show": n}; all zeros once nothing is left.
+    """
+    now = datetime.utcnow()
+    venue_ids = _deleted_ids(session, Venue, older_than, batch_size)
+    artist_ids = _deleted_ids(session, Artist, older_than, batch_size)
+    # every show of a purged venue/artist goes too, deleted or not (e.g. booked
+    # concurrently with the delete), or its foreign key would dangle
+    show_ids = set(_deleted_ids(session, Show, older_than, batch_size))
+    if venue_ids or artist_ids:
+        owned = [id for id, in session.query(Show.id)
+                 .execution_options(include_deleted=True)
+                 .filter(or_(Show.venue_id.in_(venue_ids), Show.artist_id.in_(artist_ids)))
+                 .order_by(Show.id)
+                 .limit(batch_size + 1)]
+        if len(owned) > batch_size:
+            # more shows than one batch: move a batch of them now and their
+            # owners on a later call, once the rest have followed
+            owned = owned[:batch_size]
+            venue_ids, artist_ids = [], []
+        show_ids.update(owned)
+
+    if show_ids:
+        _archive(session, Show, show_ids, now)
+    if venue_ids:
+        session.execute(venue_genre_table.delete().where(venue_genre_table.c.venue_id.in_(venue_ids)))
+        _archive(session, Venue, venue_ids, now)
+    if artist_ids:
+        session.execute(artist_genre_table.delete().where(artist_genre_table.c.artist_id.in_(artist_ids)))
+        _archive(session, Artist, artist_ids, now)
+    return {'venue': len(venue_ids), 'artist': len(artist_ids), 'show': len(show_ids)}
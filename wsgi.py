@@ -0,0 +1,11 @@
+#----------------------------------------------------------------------------#
+# WSGI entry point.
+#----------------------------------------------------------------------------#
+
+# WSGI servers load wsgi:app.  The app is built here rather than in app.py,
+# so importing app (flask CLI, benchmarks, scripts) builds nothing; `flask`
+# with FLASK_APP=app finds create_app() and calls it.
+
+from app import create_app
+
+app = create_app()